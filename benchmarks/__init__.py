@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+""" Performance benchmarks
+
+These run the main pipeline stages (``dump``, loading, pickling,
+``to-sigal`` and bbcode conversion) against a synthetic gallery2
+database, and report timings, throughput, peak RSS and query counts::
+
+    python -m benchmarks.run --depth 3 --fanout 4 --items 20
+
+Results are compared to ``benchmarks/baseline.json``, if it has any.
+Use ``--save-baseline`` to record a new baseline.
+
+This package is not installed with ``g2_metadata``.
+
+"""
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+""" Generate synthetic gallery2 databases.
+
+The gallery is a tree of albums, ``depth`` levels deep below the root
+album, with ``fanout`` subalbums per album.  Each album contains
+``items`` photos.  Titles are short; summaries and descriptions are
+about ``text_size`` characters of bbcode.
+
+"""
+from __future__ import absolute_import
+
+import itertools
+import random
+
+from g2_metadata import models
+from g2_metadata.models.access import t_UserGroupMap
+from g2_metadata.models.entity import FileSystemEntity
+from g2_metadata.models.item import t_Item, t_ItemAttributesMap
+from g2_metadata.models.plugin import PluginParameterMap
+from g2_metadata.standin import BatchInserter
+
+TIMESTAMP = 1262304000          # 2010-01-01
+
+ADMIN_ID = 2
+EVERYBODY_ID = 3
+ADMINS_ID = 4
+ACCESS_LIST_ID = 5
+
+WORDS = (u'lorem ipsum dolor sit amet consectetur adipiscing elit sed do'
+         u' eiusmod tempor incididunt ut labore et dolore magna aliqua'
+         u' caf\xe9 na\xefve ☃ "quoted" fish&chips').split()
+
+
+def bbcode_text(rng, size):
+    """ Generate about ``size`` characters of text with bbcode markup.
+    """
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        r = rng.random()
+        if r < 0.05:
+            word = u'[b]%s[/b]' % word
+        elif r < 0.1:
+            word = u'[i]%s[/i]' % word
+        elif r < 0.12:
+            word = u'[url=http://example.com/%s]%s[/url]' % (word, word)
+        elif r < 0.14:
+            word = u'[color=green]%s[/color]' % word
+        elif r < 0.16:
+            word += u'\n'
+        words.append(word)
+        length += len(word) + 1
+    return u' '.join(words)
+
+
+def generate(engine, depth=3, fanout=4, items=10, text_size=200, seed=0):
+    """ Fill the (empty) gallery2 tables in ``engine`` with a synthetic
+    gallery.
+
+    Returns the number of items (albums and photos) created.
+    """
+    rng = random.Random(seed)
+    ids = itertools.count(ACCESS_LIST_ID + 1)
+
+    with engine.begin() as conn:
+        rows = BatchInserter(conn)
+
+        def entity(entity_id, entity_type, parent_id=None):
+            rows.add(models.Entity.__table__,
+                     id=entity_id, entityType=entity_type,
+                     creationTimestamp=TIMESTAMP,
+                     modificationTimestamp=TIMESTAMP + entity_id,
+                     isLinkable=0, serialNumber=1)
+            if parent_id is not None:
+                rows.add(models.ChildEntity.__table__,
+                         id=entity_id, parentId=parent_id)
+
+        def item(cls, parent_id, path_component, sequence, order_weight,
+                 **columns):
+            item_id = next(ids)
+            entity(item_id, cls.__mapper_args__['polymorphic_identity'],
+                   parent_id)
+            rows.add(FileSystemEntity.__table__,
+                     id=item_id, pathComponent=path_component)
+            rows.add(t_Item,
+                     id=item_id,
+                     canContainChildren=int(cls is models.AlbumItem),
+                     title=u' '.join(rng.sample(WORDS, 3)),
+                     summary=bbcode_text(rng, text_size // 4),
+                     description=bbcode_text(rng, text_size),
+                     keywords=u' '.join(rng.sample(WORDS, 2)),
+                     ownerId=ADMIN_ID,
+                     viewedSinceTimestamp=TIMESTAMP,
+                     originationTimestamp=TIMESTAMP + item_id)
+            rows.add(t_ItemAttributesMap,
+                     _ItemAttributesMap_itemId=item_id,
+                     viewCount=rng.randrange(1000),
+                     orderWeight=order_weight,
+                     parentSequence=sequence)
+            rows.add(cls.__table__, id=item_id, **columns)
+            rows.add(models.AccessSubscriberMap.__table__,
+                     itemId=item_id, accessListId=ACCESS_LIST_ID)
+            return item_id
+
+        def album(parent_id, path_component, sequence, order_weight, level):
+            album_id = item(models.AlbumItem, parent_id, path_component,
+                            sequence, order_weight,
+                            orderBy=None, orderDirection=None)
+            sequence = '%s%d/' % (sequence, album_id)
+            n_items = 1
+            photo_ids = [
+                item(models.PhotoItem, album_id, 'photo%04d.jpg' % n,
+                     sequence, n, width=640, height=480)
+                for n in range(items)]
+            n_items += len(photo_ids)
+            if photo_ids:
+                # The album's hilight
+                thumbnail_id = next(ids)
+                entity(thumbnail_id, 'GalleryDerivativeImage', album_id)
+                rows.add(models.Derivative.__table__,
+                         id=thumbnail_id, derivativeSourceId=photo_ids[0],
+                         derivativeOrder=0, derivativeType=1,
+                         mimeType='image/jpeg')
+                rows.add(models.DerivativeImage.__table__,
+                         id=thumbnail_id, width=150, height=150)
+            if level < depth:
+                for n in range(fanout):
+                    n_items += album(album_id, 'album%03d' % n, sequence,
+                                   items + n, level + 1)
+            return n_items
+
+        entity(ADMIN_ID, 'GalleryUser')
+        rows.add(models.User.__table__, id=ADMIN_ID, userName='admin',
+                 fullName=u'Gallery Administrator',
+                 email='admin@example.com')
+        entity(EVERYBODY_ID, 'GalleryGroup')
+        rows.add(models.Group.__table__, id=EVERYBODY_ID, groupType=2,
+                 groupName='Everybody')
+        entity(ADMINS_ID, 'GalleryGroup')
+        rows.add(models.Group.__table__, id=ADMINS_ID, groupType=1,
+                 groupName='Site Admins')
+        rows.add(t_UserGroupMap, userId=ADMIN_ID, groupId=EVERYBODY_ID)
+        rows.add(t_UserGroupMap, userId=ADMIN_ID, groupId=ADMINS_ID)
+        rows.add(models.AccessMap.__table__, accessListId=ACCESS_LIST_ID,
+                 userOrGroupId=EVERYBODY_ID, permission=7)
+        rows.add(models.AccessMap.__table__, accessListId=ACCESS_LIST_ID,
+                 userOrGroupId=ADMINS_ID, permission=2147483647)
+        for name, value in [('default.orderBy', 'orderWeight'),
+                            ('default.orderDirection', 'asc')]:
+            rows.add(PluginParameterMap.__table__,
+                     pluginType='module', pluginId='core', itemId=0,
+                     parameterName=name, parameterValue=value)
+
+        n_items = album(0, None, '', 0, 0)
+        rows.flush()
+    return n_items
+
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+""" Run the benchmarks.
+
+"""
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import io
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import click
+import sqlalchemy as sa
+
+from g2_metadata import dumper, loader, markup, meta, models, sigal, standin
+from g2_metadata.util import walk_items
+
+from . import generate
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Fractional slowdown (relative to the baseline) reported as a regression
+TOLERANCE = 0.25
+
+
+def peak_rss():
+    """ Peak resident set size of this process, in kilobytes.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss //= 1024         # bytes, on OS X
+    return maxrss
+
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        self.count = 0
+        sa.event.listen(engine, 'before_cursor_execute', self)
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+class Benchmarks(object):
+    def __init__(self, engine, query_counter):
+        self.engine = engine
+        self.query_counter = query_counter
+        self.results = OrderedDict()
+
+    @contextmanager
+    def measure(self, name, count):
+        """ Time the block, which processes ``count`` items.
+        """
+        queries = self.query_counter.count
+        start = time.time()
+        yield
+        seconds = time.time() - start
+        self.results[name] = OrderedDict([
+            ('seconds', round(seconds, 4)),
+            ('items_per_second', round(count / seconds, 1)
+             if seconds else None),
+            ('queries', self.query_counter.count - queries),
+            ('peak_rss_kb', peak_rss()),
+            ])
+
+    def run(self, workdir, count):
+        session = sa.orm.Session(bind=self.engine)
+        yaml_path = os.path.join(workdir, 'metadata.yml')
+        with self.measure('dump_metadata', count):
+            with open(yaml_path, 'w') as fp:
+                dumper.dump_metadata(session, fp)
+        session.close()
+
+        with self.measure('loader.load', count):
+            with io.open(yaml_path, 'rb') as fp:
+                metadata = loader.load(fp)
+
+        pck_path = os.path.join(workdir, 'metadata.pck')
+        with self.measure('pickle_roundtrip', count):
+            with open(pck_path, 'wb') as fp:
+                pickle.dump(metadata, fp, pickle.HIGHEST_PROTOCOL)
+            with open(pck_path, 'rb') as fp:
+                metadata = pickle.load(fp)
+
+        albums_path = os.path.join(workdir, 'albums')
+        make_albums_tree(metadata, albums_path)
+        with self.measure('sigal.write_metadata', count):
+            sigal.write_metadata(metadata, albums_path)
+
+        descriptions = [item.description
+                        for item in walk_items(metadata['album'])
+                        if item.description]
+        with self.measure('markup.bbcode_to_markdown', len(descriptions)):
+            for description in descriptions:
+                markup.bbcode_to_markdown(description)
+
+        return self.results
+
+
+def make_albums_tree(metadata, albums_path):
+    """ Create the album directories and (empty) image files which
+    ``to-sigal`` expects to find.
+    """
+    for item in walk_items(metadata['album']):
+        path = os.path.join(albums_path, item.path)
+        if isinstance(item, meta.AlbumItem):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        else:
+            open(path, 'w').close()
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """ Compare ``results`` to ``baseline``.
+
+    Returns a list of descriptions of regressions.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name) or {}
+        seconds = base.get('seconds')
+        if seconds and result['seconds'] > seconds * (1 + tolerance):
+            regressions.append("%s: %.3fs (baseline %.3fs)"
+                               % (name, result['seconds'], seconds))
+        queries = base.get('queries')
+        if queries is not None and result['queries'] > queries:
+            regressions.append("%s: %d queries (baseline %d)"
+                               % (name, result['queries'], queries))
+    return regressions
+
+
+@click.command()
+@click.option('--depth', default=3, show_default=True,
+              help="Depth of the album tree")
+@click.option('--fanout', default=4, show_default=True,
+              help="Number of subalbums per album")
+@click.option('--items', default=10, show_default=True,
+              help="Number of photos per album")
+@click.option('--text-size', default=200, show_default=True,
+              help="Approximate size of descriptions")
+@click.option('--seed', default=0, show_default=True)
+@click.option('--db', type=click.Path(dir_okay=False),
+              help="Use (or create) this SQLite database"
+              " [default: in memory]")
+@click.option('--baseline', default=BASELINE, show_default=True,
+              type=click.Path(dir_okay=False))
+@click.option('--save-baseline', is_flag=True,
+              help="Save the results as the new baseline.")
+def main(depth, fanout, items, text_size, seed, db, baseline,
+         save_baseline):
+    """ Benchmark g2_metadata on a synthetic gallery.
+    """
+    parameters = OrderedDict([
+        ('depth', depth),
+        ('fanout', fanout),
+        ('items', items),
+        ('text_size', text_size),
+        ('seed', seed),
+        ])
+
+    exists = db is not None and os.path.exists(db)
+    engine = standin.create_engine(db)
+    if exists:
+        count = sa.orm.Session(bind=engine).query(sa.func.count(
+            models.Item.id)).scalar()
+    else:
+        count = generate.generate(engine, depth, fanout, items, text_size,
+                                  seed)
+    click.echo("%d items" % count)
+
+    workdir = tempfile.mkdtemp()
+    try:
+        benchmarks = Benchmarks(engine, QueryCounter(engine))
+        results = benchmarks.run(workdir, count)
+    finally:
+        shutil.rmtree(workdir)
+
+    for name, result in results.items():
+        click.echo("{0:<28s} {seconds:8.3f}s {items_per_second:>10} items/s"
+                   " {queries:6d} queries {peak_rss_kb:8d} kB peak RSS"
+                   .format(name, **result))
+
+    if os.path.exists(baseline):
+        with open(baseline) as fp:
+            saved = json.load(fp)
+    else:
+        saved = {}
+
+    if save_baseline:
+        with open(baseline, 'w') as fp:
+            json.dump(OrderedDict([('parameters', parameters),
+                                   ('results', results)]),
+                      fp, indent=2, separators=(',', ': '))
+            fp.write('\n')
+    elif saved.get('parameters') != parameters:
+        click.echo("Parameters differ from those of the baseline;"
+                   " not comparing.", err=True)
+    else:
+        regressions = compare(results, saved.get('results') or {})
+        for regression in regressions:
+            click.echo("REGRESSION: %s" % regression, err=True)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+""" Benchmark the startup time of the command line interface.
+
+Each command is run several times, in a fresh interpreter, and the
+best time is reported::
+
+    python -m benchmarks.startup
+
+The time to start a bare interpreter is reported for comparison.
+
+"""
+from __future__ import absolute_import
+
+import os
+import subprocess
+import sys
+import time
+
+import click
+
+COMMANDS = [
+    ['fix-exif', '--help'],
+    ['yaml-to-pck', '--help'],
+    ['--help'],
+    ]
+
+# ``g2_metadata fix-exif --help`` should start in less than this
+# (in seconds, not counting the interpreter's own startup time)
+TARGET = 0.1
+
+MAIN = ('import sys; from g2_metadata.main import main;'
+        ' sys.exit(main(prog_name="g2-metadata"))')
+
+
+def best_time(argv, repeat):
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call(argv, stdout=devnull)
+            times.append(time.time() - start)
+    return min(times)
+
+
+@click.command()
+@click.option('--repeat', default=10, show_default=True)
+def main(repeat):
+    """ Benchmark startup time of the command line interface.
+    """
+    baseline = best_time([sys.executable, '-c', 'pass'], repeat)
+    click.echo("{0:<32s} {1:8.3f}s".format('(interpreter)', baseline))
+    slow = False
+    for args in COMMANDS:
+        seconds = best_time([sys.executable, '-c', MAIN] + args, repeat)
+        click.echo("{0:<32s} {1:8.3f}s".format(' '.join(args), seconds))
+        if args[0] == 'fix-exif' and seconds - baseline > TARGET:
+            slow = True
+    if slow:
+        click.echo("fix-exif startup exceeds %.3fs" % TARGET, err=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
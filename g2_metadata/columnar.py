@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+""" Columnar (Parquet or Arrow IPC) export of the item hierarchy.
+
+This writes one row per item, with one column per item attribute, for
+bulk analytics with vectorized tools.  Columns which only apply to some
+item classes (e.g. ``width`` or ``duration``) are null for the others.
+
+The rows can come either from the db (see ``iter_db_records``) or from
+loaded metadata (see ``iter_snapshot_records``.)
+
+This requires pyarrow_, which is an optional dependency.
+
+.. _pyarrow: https://arrow.apache.org/docs/python/
+
+"""
+from __future__ import absolute_import
+
+from .util import walk_items
+
+FORMATS = ('parquet', 'arrow')
+
+BATCH_SIZE = 10000
+
+
+def _schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ('id', pa.int64()),
+        ('parentId', pa.int64()),
+        ('class', pa.string()),
+        ('path', pa.string()),
+        ('pathComponent', pa.string()),
+        ('title', pa.string()),
+        ('summary', pa.string()),
+        ('description', pa.string()),
+        ('keywords', pa.string()),
+        ('ownerId', pa.int64()),
+        ('linkId', pa.int64()),
+        ('is_hidden', pa.bool_()),
+        ('viewCount', pa.int64()),
+        ('orderWeight', pa.int64()),
+        ('creationTimestamp', pa.timestamp('s')),
+        ('modificationTimestamp', pa.timestamp('s')),
+        ('originationTimestamp', pa.timestamp('s')),
+        ('viewedSinceTimestamp', pa.timestamp('s')),
+        ('serialNumber', pa.int64()),
+        # AlbumItem
+        ('orderBy', pa.string()),
+        ('orderDirection', pa.string()),
+        ('theme', pa.string()),
+        ('hilightId', pa.int64()),
+        # PhotoItem, MovieItem, AnimationItem
+        ('width', pa.int32()),
+        ('height', pa.int32()),
+        # MovieItem
+        ('duration', pa.int32()),
+        # LinkItem
+        ('link', pa.string()),
+        # DataItem
+        ('mimeType', pa.string()),
+        ('size', pa.int64()),
+        ])
+
+
+def iter_db_records(session, root=None):
+    """ Generate flat item records from the db (for the items in the
+    subtree under ``root``, if given.)
+
+    Only the columns in the schema are fetched.
+    """
+    from .dumper import iter_item_rows
+
+    return iter_item_rows(session, _schema().names, root)
+
+
+def iter_snapshot_records(metadata):
+    """ Generate flat item records from loaded metadata.
+    """
+    names = _schema().names
+    for item in walk_items(metadata['album']):
+        record = dict((name, getattr(item, name, None)) for name in names)
+        record['class'] = item.__class__.__name__
+        hilight = getattr(item, 'hilight', None)
+        record['hilightId'] = hilight.id if hilight is not None else None
+        yield record
+
+
+def _open_writer(path, fmt, schema):
+    import pyarrow as pa
+
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(path, schema)
+    else:
+        return pa.RecordBatchFileWriter(path, schema)
+
+
+def dump(records, path, fmt='parquet'):
+    """ Write item ``records`` to a Parquet or Arrow IPC file.
+
+    Records for comments (as generated by
+    ``g2_metadata.dumper.NormalizedRecords.items``) are skipped.
+    """
+    import pyarrow as pa
+
+    assert fmt in FORMATS
+    schema = _schema()
+    names = schema.names
+    types = [field.type for field in schema]
+
+    def write(columns):
+        arrays = [pa.array(values, type=type_)
+                  for values, type_ in zip(columns, types)]
+        batch = pa.RecordBatch.from_arrays(arrays, names)
+        if fmt == 'parquet':
+            writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+
+    writer = _open_writer(path, fmt, schema)
+    try:
+        columns = [[] for name in names]
+        for record in records:
+            if record['class'] == 'Comment':
+                continue
+            for name, values in zip(names, columns):
+                values.append(record.get(name))
+            if len(columns[0]) >= BATCH_SIZE:
+                write(columns)
+                columns = [[] for name in names]
+        if columns[0]:
+            write(columns)
+    finally:
+        writer.close()
@@ -10,12 +10,18 @@ from collections import (
     Sequence,
     )
 from datetime import datetime
+from itertools import islice
+import os
 import re
 
 import sqlalchemy as sa
 import yaml
 
 from . import models
+from . import normalized
+from .models.types import Timestamp
+from .traversal import walk
+from .util import atomic_open
 
 
 class Dumper(yaml.Dumper):
@@ -82,6 +88,26 @@ Dumper.add_representer(long, Dumper.represent_long)
 Dumper.add_multi_representer(object, Dumper.represent_object)
 
 
+class SubtreeDumper(Dumper):
+    """ Dump a subtree of the gallery.
+
+    The subtree's root is dumped without a parent.  Items outside the
+    subtree (e.g. the targets of links) are dumped without their parents
+    or subitems.
+    """
+    root = None
+    item_ids = frozenset()
+
+    def filter_items(self, obj, items):
+        if obj is self.root:
+            return [(attr, None if attr == 'parent' else value)
+                    for attr, value in items]
+        elif isinstance(obj, models.Item) and obj.id not in self.item_ids:
+            return [(attr, value) for attr, value in items
+                    if attr not in ('parent', 'subitems')]
+        return items
+
+
 class TestDumper(object):
     def dump(self, data):
         dumped = yaml.dump(data, Dumper=Dumper)
@@ -100,8 +126,42 @@ class TestDumper(object):
         assert self.dump(42L) == u'42'
 
 
-def get_gallery_metadata(session):
+def find_album(session, path=None, item_id=None):
+    """ Find an album by ``path`` (relative to the albums root) or by
+    ``item_id``.  (With neither, find the gallery's top-level album.)
+
+    Returns ``None`` if there is no such album.
+    """
+    AlbumItem = models.AlbumItem
+    if item_id is not None:
+        return session.query(AlbumItem).get(item_id)
+    album = session.query(AlbumItem).filter_by(parentId=0).one()
+    for name in (path or '').split('/'):
+        if name and name != '.':
+            album = session.query(AlbumItem)\
+                           .filter_by(parentId=album.id, pathComponent=name)\
+                           .first()
+            if album is None:
+                break
+    return album
+
+
+def subtree_criterion(root):
+    """ A criterion matching ``root`` and all of its descendants.
+
+    The descendants are found by a (single, indexed) prefix match on
+    ``parentSequence``.
+    """
+    Item = models.Item
+    prefix = '%s%d/' % (root.parentSequence, root.id)
+    return sa.or_(Item.id == root.id, Item.parentSequence.like(prefix + '%'))
+
+
+def get_gallery_metadata(session, root=None):
     """ Get all pertinent data from the db.
+
+    If ``root`` (an album) is given, only the items in its subtree are
+    included.
     """
     # Precache all the items in the gallery, so we don't have to query each one
     # individually.
@@ -130,22 +190,447 @@ def get_gallery_metadata(session):
             sa.orm.subqueryload('accessList').joinedload('userOrGroup'),
             # sa.orm.subqueryload(derivatives).joinedload('source'),
             )
-        ).all()
+        )
+    if root is not None:
+        cache_items = cache_items.filter(subtree_criterion(root))
+    cache_items = cache_items.all()
 
     data = OrderedDict()
     data['groups'] = session.query(models.Group).all()
     data['users'] = session.query(models.User).all()
     data['plugin_parameters'] = models.get_global_plugin_parameters(session)
 
-    # Find the top-level album for the gallery
-    data['album'] = session.query(models.AlbumItem).filter_by(parentId=0)\
-                                                   .one()
+    if root is None:
+        # Find the top-level album for the gallery
+        root = find_album(session)
+    data['album'] = root
     return data
 
 
-def dump_metadata(session, stream):
-    data = get_gallery_metadata(session)
-    yaml.dump(data, stream, Dumper,
+def dump_metadata(session, stream, root=None):
+    data = get_gallery_metadata(session, root)
+    dumper = Dumper
+    if root is not None:
+        dumper = type('SubtreeDumper', (SubtreeDumper,), {
+            'root': root,
+            # (get_gallery_metadata has loaded the whole subtree)
+            'item_ids': frozenset(item.id for item in walk(root)),
+            })
+    yaml.dump(data, stream, dumper,
               width=65,
               default_flow_style=False,
               explicit_start=True)
+
+
+def _get_item_paths(session, root=None):
+    """ Compute the paths of all items, without loading the items themselves.
+
+    If ``root`` is given, only the paths of the items in its subtree
+    are computed.
+
+    Returns a dict mapping item id to path.
+    """
+    Item = models.Item
+    query = session.query(Item.id, Item.parentId, Item.pathComponent)
+    paths = {}
+    if root is not None:
+        query = query.filter(subtree_criterion(root))
+        paths[root.id] = root.path
+    parents = dict(
+        (item_id, (parent_id, path_component))
+        for item_id, parent_id, path_component in query)
+    for item_id in parents:
+        chain = []
+        while item_id in parents and item_id not in paths:
+            chain.append(item_id)
+            item_id = parents[item_id][0]
+        path = paths.get(item_id, '')
+        for item_id in reversed(chain):
+            parent_id, path_component = parents[item_id]
+            if parent_id in parents:
+                path = os.path.join(path, path_component)
+            paths[item_id] = path
+    return paths
+
+
+def _timestamp_fields():
+    return sorted(set(
+        column.key
+        for table in models.metadata.tables.values()
+        for column in table.columns
+        if isinstance(column.type, Timestamp)))
+
+
+def _record(obj, access_list_ids, *leading):
+    """ Flatten an ORM instance to a record for the normalized layout.
+
+    The record contains the values of the column attributes of ``obj``.
+    References to other entities are given by id.
+    """
+    columns = sa.inspect(obj).mapper.columns
+    record = OrderedDict([('class', obj.__class__.__name__)])
+    record.update(leading)
+    record.update((attr, getattr(obj, attr))
+                  for attr in obj.__yaml_attributes__ if attr in columns)
+    record['accessListId'] = access_list_ids.get(obj.id)
+    return record
+
+
+class _AlbumExtras(object):
+    """ The hilights, derivative prefs and plugin parameters of a batch
+    of albums, loaded with one query each.
+    """
+    def __init__(self, session, album_ids):
+        if album_ids:
+            self.hilight_ids = models.get_hilight_ids(session, album_ids)
+            self.derivative_prefs = models.get_derivative_prefs(session,
+                                                                album_ids)
+            self.plugin_parameters = models.get_plugin_parameters(session,
+                                                                  album_ids)
+        else:
+            self.hilight_ids = self.derivative_prefs = {}
+            self.plugin_parameters = {}
+
+
+def _item_record(item, paths, access_list_ids, extras):
+    record = _record(item, access_list_ids, ('path', paths[item.id]))
+    record['is_hidden'] = item.is_hidden
+    if isinstance(item, models.AlbumItem):
+        record['hilightId'] = extras.hilight_ids.get(item.id)
+        record['derivative_prefs'] = extras.derivative_prefs.get(item.id,
+                                                                 {})
+        record['plugin_parameters'] = extras.plugin_parameters.get(item.id)
+    return record
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            break
+        yield batch
+
+
+class NormalizedRecords(object):
+    """ The records of the normalized layout.
+
+    See ``g2_metadata.normalized`` for a description of the layout.
+    Iterating over an instance generates the header followed by the
+    records for all items and comments.  Items are streamed from the
+    db, so they are not all in memory at the same time.
+
+    If ``root`` (an album) is given, only the records of the items (and
+    comments) in its subtree are generated.
+
+    """
+    def __init__(self, session, batch_size=500, root=None):
+        self.session = session
+        self.batch_size = batch_size
+
+        subscriptions = models.AccessSubscriberMap
+        self.access_list_ids = dict(session.query(subscriptions.itemId,
+                                                  subscriptions.accessListId))
+        self.paths = _get_item_paths(session, root)
+        if root is None:
+            self.root = find_album(session)
+            self.subtree = None
+        else:
+            self.root = root
+            self.subtree = subtree_criterion(root)
+
+    def __iter__(self):
+        yield self.header()
+        for record in self.items():
+            yield record
+
+    def header(self):
+        session = self.session
+        access_list_ids = self.access_list_ids
+
+        access_lists = OrderedDict()
+        for entry in session.query(models.AccessMap)\
+                            .order_by(models.AccessMap.accessListId):
+            access_lists.setdefault(entry.accessListId, []).append(
+                OrderedDict([
+                    ('userOrGroupId', entry.userOrGroupId),
+                    ('permission', entry.permission),
+                    ]))
+
+        users = session.query(models.User).options(
+            sa.orm.subqueryload(models.User._plugin_parameters),
+            sa.orm.subqueryload('groups'))
+
+        header = OrderedDict()
+        header['layout'] = normalized.LAYOUT
+        header['root'] = self.root.id
+        header['groups'] = [_record(group, access_list_ids)
+                            for group in session.query(models.Group)]
+        header['users'] = []
+        for user in users:
+            record = _record(user, access_list_ids)
+            record['groupIds'] = [group.id for group in user.groups]
+            record['plugin_parameters'] = user.plugin_parameters
+            header['users'].append(record)
+        header['access_lists'] = access_lists
+        header['plugin_parameters'] = \
+            models.get_global_plugin_parameters(session)
+        # The names of fields which hold timestamps.  (Needed by
+        # formats, like JSON, which have no native timestamps.)
+        header['timestamps'] = _timestamp_fields()
+        return header
+
+    def items(self, criterion=None):
+        """ Generate the records for the items matching ``criterion``
+        (by default, all items in the subtree), followed by those for
+        their comments.
+
+        """
+        session = self.session
+        Item = models.Item
+        Comment = models.Comment
+
+        items = (
+            session.query(Item)
+            .with_polymorphic('*')
+            .options(sa.orm.lazyload('linked_item'))
+            .order_by(Item.parentId, Item.orderWeight, Item.id))
+        comments = session.query(Comment)\
+                          .order_by(Comment.parentId, Comment.date)
+        if criterion is None:
+            criterion = self.subtree
+        if criterion is not None:
+            items = items.filter(criterion)
+            item_ids = session.query(Item.id).filter(criterion)
+            comments = comments.filter(Comment.parentId.in_(item_ids))
+
+        for batch in _batches(items.yield_per(self.batch_size),
+                              self.batch_size):
+            extras = _AlbumExtras(session, [
+                item.id for item in batch
+                if isinstance(item, models.AlbumItem)])
+            for item in batch:
+                yield _item_record(item, self.paths, self.access_list_ids,
+                                   extras)
+        for comment in comments.yield_per(self.batch_size):
+            yield _record(comment, self.access_list_ids)
+
+
+def iter_item_rows(session, names, root=None, batch_size=500):
+    """ Generate flat records of the items (only), with just the fields
+    in ``names``.
+
+    The fields may be the column attributes of any of the item classes
+    (they are null for the items of other classes), ``class``, ``path``,
+    ``is_hidden`` or ``hilightId``.  Only those columns are fetched; no
+    relationships are loaded.
+
+    If ``root`` (an album) is given, only the items in its subtree are
+    generated.
+    """
+    Item = models.Item
+    mapper = sa.inspect(Item)
+    selectable = sa.inspect(sa.orm.with_polymorphic(Item, '*')).selectable
+    computed = ('class', 'path', 'is_hidden', 'hilightId')
+    columns = [mapper.polymorphic_on, mapper.columns['id'],
+               mapper.columns['_ItemHiddenMap_itemId']]
+    for name in names:
+        if name in computed:
+            continue
+        elif name in mapper.columns:
+            column = mapper.columns[name]
+        else:
+            # Columns of the item subclasses (e.g. ``width``)
+            subclass_columns = [
+                submapper.local_table.c[name]
+                for submapper in mapper.self_and_descendants
+                if name in submapper.local_table.c]
+            if not subclass_columns:
+                column = sa.null()
+            elif len(subclass_columns) == 1:
+                column, = subclass_columns
+            else:
+                column = sa.func.coalesce(*subclass_columns)
+        columns.append(column.label(name))
+
+    query = (sa.select(columns)
+             .select_from(selectable)
+             .order_by(mapper.columns['parentId'],
+                       mapper.columns['orderWeight'],
+                       mapper.columns['id']))
+    if root is not None:
+        query = query.where(subtree_criterion(root))
+    paths = _get_item_paths(session, root)
+    result = session.connection().execution_options(
+        stream_results=True).execute(query)
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        classes = [mapper.polymorphic_map[row[0]].class_ for row in rows]
+        album_ids = [row[1] for row, cls in zip(rows, classes)
+                     if issubclass(cls, models.AlbumItem)]
+        hilight_ids = {}
+        if album_ids and 'hilightId' in names:
+            hilight_ids = models.get_hilight_ids(session, album_ids)
+        for row, cls in zip(rows, classes):
+            item_id = row[1]
+            record = dict(zip(names, [None] * len(names)))
+            record.update(zip(row.keys()[3:], row[3:]))
+            record.update({
+                'class': cls.__name__,
+                'path': paths[item_id],
+                'is_hidden': row[2] is not None,
+                'hilightId': hilight_ids.get(item_id),
+                })
+            yield dict((name, record[name]) for name in names)
+
+
+def _dump_all(documents, stream):
+    yaml.dump_all(documents, stream, Dumper,
+                  width=65,
+                  default_flow_style=False,
+                  explicit_start=True)
+
+
+def dump_normalized_metadata(session, stream, root=None):
+    _dump_all(NormalizedRecords(session, root=root), stream)
+
+
+def dump_sharded_metadata(session, shard_dir, root=None):
+    """ Dump the normalized layout, sharded by top-level album.
+
+    The index file (``index.yml``) in ``shard_dir`` contains the header,
+    along with the records for the root album and the top-level items.
+    The header's ``shards`` maps the id of each top-level album to the
+    name of the shard file containing the records for all of its
+    descendants, and its ``item_shards`` maps the id of each of those
+    descendants to the id of its top-level album.
+
+    """
+    Item = models.Item
+    records = NormalizedRecords(session, root=root)
+    root = records.root
+
+    top_level = sa.or_(Item.id == root.id, Item.parentId == root.id)
+    index_records = list(records.items(top_level))
+    shards = OrderedDict(
+        (record['id'], 'album-%d.yml' % record['id'])
+        for record in index_records
+        if record['class'] == 'AlbumItem' and record['id'] != root.id)
+
+    # Descendants of the top-level albums are found by their
+    # parentSequence, which starts with the top-level album's id
+    root_prefix = '%s%d/' % (root.parentSequence, root.id)
+    descendant_ids = (session.query(Item.id, Item.parentSequence)
+                      .filter(Item.parentSequence.like(root_prefix + '%_'))
+                      .order_by(Item.id))
+    item_shards = OrderedDict()
+    for item_id, parent_sequence in descendant_ids:
+        album_id = int(parent_sequence[len(root_prefix):].split('/', 1)[0])
+        if album_id in shards:
+            item_shards[item_id] = album_id
+
+    # Each file is written to a temporary file, which is renamed into
+    # place, and the index is written last, so that a reader never sees
+    # a partially written shard, nor an index without its shards
+    for album_id, filename in shards.items():
+        prefix = '%s%d/%d/' % (root.parentSequence, root.id, album_id)
+        descendants = Item.parentSequence.like(prefix + '%')
+        with atomic_open(os.path.join(shard_dir, filename)) as fp:
+            _dump_all(records.items(descendants), fp)
+
+    header = records.header()
+    header['shards'] = shards
+    header['item_shards'] = item_shards
+    with atomic_open(os.path.join(shard_dir, normalized.SHARD_INDEX)) as fp:
+        _dump_all([header] + index_records, fp)
+
+
+def test_dump_sharded_metadata(tmpdir, monkeypatch):
+    from sqlalchemy.orm import Session
+    from .loader import load_shards
+    from .standin import create_engine, sample_gallery
+
+    engine = create_engine()
+    sample_gallery(engine)
+    session = Session(bind=engine)
+    dump_sharded_metadata(session, str(tmpdir))
+    assert sorted(path.basename for path in tmpdir.listdir()) \
+        == ['album-2.yml', 'album-5.yml', normalized.SHARD_INDEX]
+    metadata = load_shards(str(tmpdir))
+    assert metadata.item_by_path('a/q.jpg').id == 4
+
+    # Interrupted: the index is not written, nor any partial shard
+    def interrupt(documents, stream):
+        raise KeyboardInterrupt
+    monkeypatch.setattr('g2_metadata.dumper._dump_all', interrupt)
+    out = tmpdir.join('out').ensure(dir=True)
+    try:
+        dump_sharded_metadata(session, str(out))
+    except KeyboardInterrupt:
+        pass
+    assert out.listdir() == []
+
+
+def test_normalized_records():
+    from sqlalchemy.orm import Session
+    from .models.derivative import t_DerivativePrefsMap
+    from .models.plugin import PluginParameterMap
+    from .standin import create_engine, sample_gallery
+
+    engine = create_engine()
+    sample_gallery(engine)
+    with engine.begin() as conn:
+        conn.execute(t_DerivativePrefsMap.insert(), [
+            {'itemId': 2, 'order': order, 'derivativeType': dtype,
+             'derivativeOperations': ops}
+            for order, dtype, ops in [(0, 1, 'thumbnail|150'),
+                                      (0, 2, 'scale|640'),
+                                      (1, 2, 'scale|1024')]])
+        conn.execute(PluginParameterMap.__table__.insert(),
+                     pluginType='module', pluginId='comments', itemId=2,
+                     parameterName='show', parameterValue='1')
+    queries = []
+    sa.event.listen(engine, 'before_cursor_execute',
+                    lambda conn, cursor, statement, *args:
+                    queries.append(statement))
+
+    session = Session(bind=engine)
+    normalized_records = NormalizedRecords(session)
+    del queries[:]
+    records = dict((record['id'], record)
+                   for record in normalized_records.items())
+    # items, hilights (plus their sources), derivative prefs, plugin
+    # parameters and comments: the same for any number of albums
+    assert len(queries) == 6
+
+    for album in session.query(models.AlbumItem):
+        record = records[album.id]
+        assert record['hilightId'] == album.hilight.id
+        assert record['derivative_prefs'] == album.derivative_prefs
+        assert record['plugin_parameters'] == album.plugin_parameters
+    assert records[2]['derivative_prefs'] \
+        == {1: ['thumbnail|150'], 2: ['scale|640', 'scale|1024']}
+    assert records[2]['plugin_parameters'] \
+        == {'module': {'comments': {'show': '1'}}}
+
+
+def test_iter_item_rows():
+    from sqlalchemy.orm import Session
+    from .standin import create_engine, sample_gallery
+
+    engine = create_engine()
+    sample_gallery(engine)
+    session = Session(bind=engine)
+    names = ['id', 'parentId', 'class', 'path', 'title', 'is_hidden',
+             'orderWeight', 'linkId', 'modificationTimestamp', 'theme',
+             'hilightId', 'width', 'duration', 'link', 'mimeType']
+    expected = [dict((name, record.get(name)) for name in names)
+                for record in NormalizedRecords(session).items()
+                if record['class'] != 'Comment']
+    assert list(iter_item_rows(session, names, batch_size=2)) == expected
+
+    root = session.query(models.Item).get(2)
+    assert [row['path'] for row in iter_item_rows(session, ['path'], root)] \
+        == ['a', 'a/p.jpg', 'a/q.jpg']
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+""" JSON Lines export and import of the normalized layout.
+
+This is the normalized layout (see ``g2_metadata.normalized``) written
+as one JSON object per line: the header on the first line, then one
+line for each item and comment.  It loads much faster than YAML.
+
+JSON has no timestamps, so datetimes are written as ISO 8601 strings
+(as they are in the YAML); the header lists the names of the fields
+which hold them.  JSON objects can only have string keys, so mappings
+with other keys are written as ``{"__pairs__": [[key, value], ...]}``.
+
+"""
+from __future__ import absolute_import
+
+from collections import Mapping, OrderedDict
+from datetime import datetime
+import json
+
+from six import string_types, text_type
+
+from . import normalized
+
+PAIRS = '__pairs__'
+
+
+def encode(value):
+    """ Convert ``value`` to something which can be serialized to JSON.
+    """
+    if isinstance(value, datetime):
+        return value.replace(microsecond=0).isoformat() + 'Z'
+    elif isinstance(value, Mapping):
+        if all(isinstance(key, string_types) for key in value):
+            return OrderedDict((key, encode(val))
+                               for key, val in value.items())
+        return {PAIRS: [[encode(key), encode(val)]
+                        for key, val in value.items()]}
+    elif isinstance(value, (list, tuple)):
+        return [encode(val) for val in value]
+    return value
+
+
+def decode(value):
+    """ Undo ``encode`` (except for timestamps.)
+    """
+    if isinstance(value, dict):
+        if len(value) == 1 and PAIRS in value:
+            return dict((decode(key), decode(val))
+                        for key, val in value[PAIRS])
+        return dict((key, decode(val)) for key, val in value.items())
+    elif isinstance(value, list):
+        return [decode(val) for val in value]
+    return value
+
+
+def test_encode_roundtrip():
+    value = {'a': [{1: 'x', 2: None}], 'b': {'c': 'd'}}
+    assert decode(json.loads(json.dumps(encode(value)))) == value
+
+
+def _parse_timestamp(s):
+    # Much faster than datetime.strptime
+    return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                    int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
+
+def decode_record(record, timestamps):
+    """ Undo ``encode`` on a record, in place.
+
+    ``timestamps`` is the set of the names of fields holding timestamps.
+    """
+    for key, value in record.items():
+        if value is None:
+            continue
+        elif key in timestamps:
+            record[key] = _parse_timestamp(value)
+        elif isinstance(value, (dict, list)):
+            record[key] = decode(value)
+    return record
+
+
+def dump(records, stream):
+    """ Write normalized ``records`` (header first) to ``stream``.
+    """
+    for record in records:
+        line = json.dumps(encode(record), separators=(',', ':'))
+        stream.write(text_type(line) + u'\n')
+
+
+def load(stream):
+    lines = (line for line in stream if line.strip())
+    first = next(lines, None)
+    if first is None:
+        raise ValueError("no metadata found")
+    header = json.loads(first)
+    timestamps = frozenset(header.get('timestamps', ()))
+    for key in 'users', 'groups':
+        header[key] = [decode_record(record, timestamps)
+                       for record in header.get(key, ())]
+    header['access_lists'] = decode(header.get('access_lists', {}))
+    header['plugin_parameters'] = decode(header.get('plugin_parameters'))
+
+    records = (decode_record(json.loads(line), timestamps)
+               for line in lines)
+    return normalized.load_records(header, records)
@@ -4,12 +4,22 @@
 This loads what were the SQLAlchemy-mapped instances into plain
 old (non-ORM-mapped) classes.
 
+Both the nested and the normalized (see ``g2_metadata.normalized``)
+YAML layouts are understood, as are directories containing sharded
+normalized dumps.
+
 """
 from __future__ import absolute_import
 
+import io
+from multiprocessing import Pool
+import os
+
+from six import string_types
 import yaml
 
 from . import meta
+from . import normalized
 
 
 class MetaLoader(yaml.Loader):
@@ -22,4 +32,42 @@ MetaLoader.add_multi_constructor('!', MetaLoader.construct_class)
 
 
 def load(stream):
-    return yaml.load(stream, MetaLoader)
+    if isinstance(stream, string_types) and os.path.isdir(stream):
+        return load_shards(stream)
+    documents = yaml.load_all(stream, MetaLoader)
+    data = next(documents, None)
+    if data is None:
+        raise ValueError("no metadata found")
+    if data.get('layout') == normalized.LAYOUT:
+        return normalized.load_records(data, documents)
+    return data
+
+
+def _read_records(path):
+    with io.open(path, 'rb') as fp:
+        return list(yaml.load_all(fp, MetaLoader))
+
+
+def load_shards(shard_dir, jobs=None):
+    """ Load a sharded normalized dump.
+
+    By default, shards are loaded lazily, as items within them are
+    reached.  If ``jobs`` is given, all shards are instead parsed up
+    front, using a pool of that many processes.
+
+    """
+    index = _read_records(os.path.join(shard_dir, normalized.SHARD_INDEX))
+    header, records = index[0], index[1:]
+    store = normalized.ShardedRecordStore(header, shard_dir, _read_records)
+    store.add_shard(records)
+    if jobs:
+        paths = [os.path.join(shard_dir, filename)
+                 for filename in store.pending.values()]
+        pool = Pool(jobs)
+        try:
+            for shard in pool.imap_unordered(_read_records, paths):
+                store.add_shard(shard)
+        finally:
+            pool.terminate()
+        store.pending.clear()
+    return normalized.NormalizedMetadata(store, release=True)
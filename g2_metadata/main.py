@@ -11,18 +11,12 @@ except ImportError:
     import pickle
 
 import click
-import sqlalchemy as sa
 
-from . import dumper
-from . import exif
-from . import loader
-from . import markup
-from . import sigal
-
-engine = sa.create_engine('mysql://gallery@furry/gallery2?charset=utf8',
-                          echo=False)
-Session = sa.orm.sessionmaker(bind=engine)
-session = Session()
+# NB: Other modules are imported by the commands which use them, to keep
+# startup fast.  (SQLAlchemy, the models, and the markup libraries are
+# slow to import.)  Importing columnar is cheap (pyarrow is imported
+# lazily.)
+from . import columnar
 
 
 log = logging.getLogger(__name__)
@@ -32,32 +26,60 @@ class DbUrl(click.ParamType):
     name = 'dburl'
 
     def convert(self, value, param, ctx):
-        engine = sa.create_engine(value,
-                                  connect_args={'charset': 'utf8'},
-                                  echo=False)
-        return sa.orm.Session(bind=engine)
+        import sqlalchemy as sa
+        from sqlalchemy.orm import Session
+
+        url = sa.engine.url.make_url(value)
+        connect_args = {}
+        if url.get_backend_name() == 'mysql':
+            connect_args['charset'] = 'utf8'
+        engine = sa.create_engine(url, connect_args=connect_args, echo=False)
+        return Session(bind=engine)
 
 DBURL = DbUrl()
 
 
 class Metadata(click.Path):
     name = 'metadata'
+    PATH_KEY = 'g2_metadata.metadata_path'
 
     def __init__(self):
-        super(Metadata, self).__init__(exists=True, dir_okay=False)
+        super(Metadata, self).__init__(exists=True)
 
     def convert(self, value, param, ctx):
+        from . import jsonl, loader, sqlite
+
         path = super(Metadata, self).convert(value, param, ctx)
-        ext = os.path.splitext(path)[1]
+        if ctx is not None:
+            # Remembered for to-sigal's checkpoints
+            ctx.meta[self.PATH_KEY] = path
+        if os.path.isdir(path):
+            return loader.load_shards(path)  # sharded normalized dump
+        ext = os.path.splitext(path)[1].lower()
+        if ext == '.sqlite':
+            metadata = sqlite.load(path)
+            if ctx is not None:
+                ctx.call_on_close(metadata.records.close)
+            return metadata
         with io.open(path, 'rb') as fp:
-            if ext.lower() == '.pck':
+            if ext == '.pck':
                 return pickle.load(fp)
-            else:
-                return loader.load(fp)
+            try:
+                if ext == '.jsonl':
+                    return jsonl.load(fp)
+                else:
+                    return loader.load(fp)
+            except ValueError as exc:
+                self.fail("%s: %s" % (path, exc), param, ctx)
 
     @staticmethod
     def from_stdin():
-        return loader.load(sys.stdin)  # read YAML from STDIN
+        from . import loader
+
+        try:
+            return loader.load(sys.stdin)  # read YAML from STDIN
+        except ValueError as exc:
+            raise click.ClickException("<stdin>: %s" % exc)
 
 
 METADATA = Metadata()
@@ -74,15 +96,81 @@ def main(verbose):
     logging.basicConfig(level=log_level)
 
 
+def _subtree_root(find_album, path, item_id):
+    if path is not None and item_id is not None:
+        raise click.UsageError("--root and --item-id are mutually exclusive")
+    album = find_album(path, item_id)
+    if album is None:
+        if item_id is not None:
+            raise click.BadParameter("no album with id %d" % item_id,
+                                     param_hint='--item-id')
+        raise click.BadParameter("no album at %r" % path,
+                                 param_hint='--root')
+    return album
+
+
 @main.command()
-@click.option('outfp', '--output', '-o', default=sys.stdout,
-              type=click.File('w', encoding='ascii', atomic=True),
-              help="Output file (.yml) [default: stdout]")
+@click.option('--output', '-o', type=click.Path(dir_okay=False, writable=True),
+              help="Output file (.yml, .jsonl, .sqlite, .parquet, .arrow)"
+              " [default: stdout]")
+@click.option('--format', 'fmt',
+              type=click.Choice(['yaml', 'jsonl', 'sqlite']
+                                + list(columnar.FORMATS)),
+              default='yaml', show_default=True,
+              help="Output format.  JSON Lines and SQLite output always"
+              " use the normalized layout.  Parquet and Arrow IPC output"
+              " contain only items, in columnar form.")
+@click.option('--layout', type=click.Choice(['nested', 'normalized']),
+              default='nested', show_default=True,
+              help="Nest items under their albums, or emit flat tables"
+              " of records which reference each other by id.")
+@click.option('--shard-dir', type=click.Path(file_okay=False, writable=True),
+              help="Write a sharded normalized dump, with one file per"
+              " top-level album, to this directory.")
+@click.option('--root', metavar='PATH',
+              help="Dump only the album at PATH (relative to the albums"
+              " root), and its descendants.")
+@click.option('--item-id', type=int, metavar='ID',
+              help="Dump only the album with this id, and its"
+              " descendants.")
 @click.argument('dbsession', type=DBURL, metavar='<dburi>')
-def dump(dbsession, outfp):
-    """ Dump gallery2 metadata to YAML.
+def dump(dbsession, output, fmt, layout, shard_dir, root, item_id):
+    """ Dump gallery2 metadata to YAML (or JSON Lines, or SQLite).
     """
-    dumper.dump_metadata(dbsession, outfp)
+    from . import dumper, jsonl, sqlite
+
+    if root is not None or item_id is not None:
+        root = _subtree_root(
+            lambda path, item_id: dumper.find_album(dbsession, path, item_id),
+            root, item_id)
+
+    if shard_dir is not None:
+        if fmt != 'yaml':
+            raise click.BadParameter("sharded dumps are always YAML",
+                                     param_hint='--shard-dir')
+        if not os.path.isdir(shard_dir):
+            os.makedirs(shard_dir)
+        dumper.dump_sharded_metadata(dbsession, shard_dir, root)
+    elif fmt == 'sqlite' or fmt in columnar.FORMATS:
+        if output is None:
+            raise click.BadParameter("required for %s output" % fmt,
+                                     param_hint='--output')
+        if fmt == 'sqlite':
+            sqlite.dump(dumper.NormalizedRecords(dbsession, root=root),
+                        output)
+        else:
+            columnar.dump(columnar.iter_db_records(dbsession, root),
+                          output, fmt)
+    else:
+        with click.open_file(output or '-', 'w', encoding='ascii',
+                             atomic=output is not None) as outfp:
+            if fmt == 'jsonl':
+                jsonl.dump(dumper.NormalizedRecords(dbsession, root=root),
+                           outfp)
+            elif layout == 'normalized':
+                dumper.dump_normalized_metadata(dbsession, outfp, root)
+            else:
+                dumper.dump_metadata(dbsession, outfp, root)
 
 
 @main.command(name='yaml-to-pck')
@@ -103,28 +191,156 @@ def yaml_to_pck(metadata, outfp):
 @click.option('--albums', default='albums',
               type=click.Path(exists=True, file_okay=False, writable=True),
               help="Path to albums directory", show_default=True)
+@click.option('--normalize', is_flag=True,
+              help="Normalize titles and descriptions, as the sigal"
+              " normalize_summary plugin would.")
+@click.option('--jobs', '-j', type=click.IntRange(1), default=None,
+              help="Scan directories and write files in this many"
+              " threads.")
+@click.option('--sync', is_flag=True,
+              help="Remove .md files, and symlinks to files, which do not"
+              " belong to any item.")
+@click.option('--dry-run', '-n', is_flag=True,
+              help="With --sync, only report what would be removed.")
+@click.option('--resume', is_flag=True,
+              help="Resume an interrupted run (with the same metadata and"
+              " options), skipping the albums it completed.")
+@click.option('--root', metavar='PATH',
+              help="Write metadata only for the album at PATH (relative"
+              " to the albums directory), and its descendants.")
+@click.option('--item-id', type=int, metavar='ID',
+              help="Write metadata only for the album with this id, and"
+              " its descendants.")
 @click.argument('metadata', type=METADATA, required=False,
-                metavar='[<metadata.pck>|<metadata.yml>]')
-def to_sigal(metadata, albums):
+                metavar='[<metadata.{pck,yml,jsonl,sqlite}>|<shard-dir>]')
+def to_sigal(metadata, albums, normalize, jobs, sync, dry_run, resume, root,
+             item_id):
     """ Write sigal metadata.
+
+    Progress is checkpointed (unless the metadata is read from stdin),
+    so that an interrupted run can be resumed with --resume.
+    """
+    from . import sigal
+    from .sigal.checkpoint import Journal, snapshot_key
+    from .util import find_album
+
+    if dry_run and not sync:
+        raise click.UsageError("--dry-run requires --sync")
+    if metadata is None:
+        if resume:
+            raise click.BadParameter("can not resume when reading stdin",
+                                     param_hint='--resume')
+        metadata = METADATA.from_stdin()
+    if root is not None or item_id is not None:
+        root = _subtree_root(
+            lambda path, item_id: find_album(metadata, path, item_id),
+            root, item_id)
+
+    metadata_path = click.get_current_context().meta.get(METADATA.PATH_KEY)
+    journal = None
+    if metadata_path is not None:
+        snapshot = snapshot_key(metadata_path, normalize,
+                                root.id if root is not None else None)
+        journal = Journal(albums, snapshot, resume)
+    sigal.write_metadata(metadata, albums, normalize=normalize, jobs=jobs,
+                         sync=sync, dry_run=dry_run, root=root,
+                         journal=journal)
+    if journal is not None:
+        journal.close(completed=True)
+
+
+@main.command()
+@click.option('--albums', default='albums',
+              type=click.Path(exists=True, file_okay=False, writable=True),
+              help="Path to albums directory", show_default=True)
+@click.option('--normalize', is_flag=True,
+              help="Normalize titles and descriptions, as the sigal"
+              " normalize_summary plugin would.")
+@click.option('--interval', default=10.0, show_default=True,
+              help="Seconds between polls of the database.")
+@click.option('--initial/--no-initial', default=True, show_default=True,
+              help="Write metadata for all items at startup.")
+@click.argument('dbsession', type=DBURL, metavar='<dburi>')
+def watch(dbsession, albums, normalize, interval, initial):
+    """ Watch gallery2 for changes, and keep sigal metadata up to date.
+    """
+    from .watch import Watcher
+
+    Watcher(dbsession, albums, normalize).run(interval, initial)
+
+
+@main.command(name='to-columnar')
+@click.option('--output', '-o', required=True,
+              type=click.Path(dir_okay=False, writable=True),
+              help="Output file (.parquet, .arrow)")
+@click.option('--format', 'fmt', type=click.Choice(columnar.FORMATS),
+              default='parquet', show_default=True,
+              help="Output format (Parquet, or Arrow IPC file.)")
+@click.argument('metadata', type=METADATA, required=False,
+                metavar='[<metadata.{pck,yml,jsonl,sqlite}>|<shard-dir>]')
+def to_columnar(metadata, output, fmt):
+    """ Export items to a columnar file, for analytics.
     """
     if metadata is None:
         metadata = METADATA.from_stdin()
-    sigal.write_metadata(metadata, albums)
+    columnar.dump(columnar.iter_snapshot_records(metadata), output, fmt)
+
+
+@main.command(name='to-standin')
+@click.option('--output', '-o', required=True,
+              type=click.Path(dir_okay=False, writable=True),
+              help="Output SQLite database (.db)")
+@click.argument('metadata', type=METADATA, required=False,
+                metavar='[<metadata.{pck,yml,jsonl,sqlite}>|<shard-dir>]')
+def to_standin(metadata, output):
+    """ Create a stand-in gallery2 database from metadata.
+
+    This writes the gallery2 tables to a new SQLite database, which can
+    then be dumped (e.g. ``dump sqlite:///gallery.db``) without a
+    gallery2 server.
+    """
+    from . import standin
+
+    if metadata is None:
+        metadata = METADATA.from_stdin()
+    if os.path.exists(output):
+        raise click.BadParameter("%s already exists" % output,
+                                 param_hint='--output')
+    standin.populate(standin.create_engine(output), metadata)
 
 
 @main.command(name='bbcode-test')
 @click.option('outfp', '--output', '-o', default=sys.stdout,
               type=click.File('w', encoding='utf-8', atomic=True),
               help="Output file (.html) [default: stdout]")
+@click.option('--root', metavar='PATH',
+              help="Sample only the album at PATH (relative to the albums"
+              " root), and its descendants.")
+@click.option('--item-id', type=int, metavar='ID',
+              help="Sample only the album with this id, and its"
+              " descendants.")
+@click.option('--max-depth', type=click.IntRange(0), metavar='N',
+              help="Sample items at most N levels below the root.")
+@click.option('--limit', type=click.IntRange(0), metavar='N',
+              help="Write at most N samples.")
+@click.option('--jobs', '-j', type=click.IntRange(1), default=None,
+              help="Convert samples in this many processes.")
 @click.argument('metadata', type=METADATA, required=False,
                 metavar='[<metadata.pck>|<metadata.yml>]')
-def bbcode_test(metadata, outfp):
+def bbcode_test(metadata, outfp, root, item_id, max_depth, limit, jobs):
     """ Write HTML file with bbcode conversion samples (for testing)
     """
+    from . import markup
+    from .util import find_album
+
     if metadata is None:
         metadata = METADATA.from_stdin()
-    markup.make_bbcode_test_page(metadata, outfp)
+    if root is not None or item_id is not None:
+        root = _subtree_root(
+            lambda path, item_id: find_album(metadata, path, item_id),
+            root, item_id)
+    markup.make_bbcode_test_page(metadata, outfp, root, max_depth,
+                                 limit=limit, jobs=jobs)
 
 
 @main.command(name='fix-exif')
@@ -154,5 +370,7 @@ def fix_exif(filename):
        been rotated but have a botched ``Orientation`` tag.
 
     """
+    from . import exif
+
     for fn in filename:
         exif.fix_exif(fn)
@@ -14,15 +14,19 @@ Note that Gallery2 seems to support only the following bbcode tags:
 """
 from __future__ import absolute_import
 
-import re
+from itertools import islice
+from multiprocessing import Pool
 
 import bbcode
+from six.moves import map
 from html2text import HTML2Text
 import jinja2
 from markdown import markdown
 from pkg_resources import resource_string
 
-from .util import text_, walk_items
+from . import scan
+from .traversal import walk
+from .util import text_
 
 
 bbcode_parser = bbcode.Parser(escape_html=False)
@@ -60,39 +64,81 @@ def bbcode_to_markdown(text):
 
 
 def strip_nl(text):
-    return re.sub(r'\s*?[\n\r]\s*', ' ', text)
+    return scan.NEWLINE_RE.sub(' ', text)
 
 
 def strip_bbcode(text, strip_newlines=True):
-    # NB: We have to do the newline stripping ourself. Passing
-    # strip_newlines=True to bbcode.Parser.strip really strips them
-    # completely — it doesn’t put any spaces in to replace them.
-    stripped = bbcode_parser.strip(text_(text), strip_newlines=False)
-    if strip_newlines:
+    text = text_(text)
+    markup = scan.classify(text)
+    if markup & scan.BBCODE:
+        # NB: We have to do the newline stripping ourself. Passing
+        # strip_newlines=True to bbcode.Parser.strip really strips them
+        # completely — it doesn’t put any spaces in to replace them.
+        stripped = bbcode_parser.strip(text, strip_newlines=False)
+    elif markup & scan.NEWLINE:
+        # No tags to strip, but the parser would normalize line endings
+        stripped = text.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+    else:
+        return text
+    if strip_newlines and markup & scan.NEWLINE:
         stripped = strip_nl(stripped)
     return stripped
 
 
-def make_bbcode_test_page(metadata, outfp):
-    samples = []
-    for item in walk_items(metadata['album']):
+def _bbcode_fields(root, max_depth=None):
+    # Generate (path, field, text) for fields which look like markup
+    for item in walk(root, max_depth=max_depth):
         for attr in 'title', 'summary', 'description':
             s = text_(getattr(item, attr))
-            if s and re.search(r'\[\w+.*\]|\n', s.strip()):
-                # Looks like bbcode
-                md = bbcode_to_markdown(s)
-                samples.append({
-                    'path': item.path,
-                    'field': attr,
-                    'bbcode': s,
-                    'stripped': strip_bbcode(s),
-                    'markdown': md,
-                    'html': markdown(md),
-                    })
+            if s and scan.classify(s.strip()):
+                yield item.path, attr, s
+
+
+def _bbcode_sample(field):
+    path, attr, s = field
+    md = bbcode_to_markdown(s)
+    return {
+        'path': path,
+        'field': attr,
+        'bbcode': s,
+        'stripped': strip_bbcode(s),
+        'markdown': md,
+        'html': markdown(md),
+        }
+
+
+def make_bbcode_test_page(metadata, outfp, root=None, max_depth=None,
+                          limit=None, jobs=None):
+    """ Write samples of the bbcode found under album ``root`` (by
+    default, the whole gallery), to at most ``max_depth`` levels below
+    it.
+
+    At most ``limit`` samples are written.  If ``jobs`` is given, the
+    samples are converted in that many processes.  The page is written
+    as it is rendered.
+    """
+    if root is None:
+        root = metadata['album']
+    fields = islice(_bbcode_fields(root, max_depth), limit)
 
     tmpl = jinja2.Template(
         resource_string(__name__, 'bbcode_test_page.jinja2'),
         autoescape=True,
         undefined=jinja2.StrictUndefined)
 
-    outfp.write(tmpl.render(samples=samples))
+    if not jobs or jobs == 1:
+        samples = map(_bbcode_sample, fields)
+        tmpl.stream(samples=samples).dump(outfp)
+        return
+
+    pool = Pool(jobs)
+    try:
+        samples = pool.imap(_bbcode_sample, fields, chunksize=16)
+        tmpl.stream(samples=samples).dump(outfp)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
@@ -4,23 +4,60 @@
 These are plain jane classes with the same names and inheritance
 tree as those in ``g2_metadata.models``.
 
+Instances loaded from the nested YAML layout have all their attributes
+set directly.  Instances built by a loader for one of the normalized
+layouts (see ``g2_metadata.normalized``) hold only their scalar
+attributes; references to other objects are resolved (and then cached)
+on first access.
+
 """
 # flake8: noqa
 
+
+class lazy(object):
+    """ An attribute which is resolved, on first access, by the loader
+    which built the instance.
+
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        resolver = obj.__dict__.get('_resolver')
+        if resolver is None:
+            raise AttributeError(self.name)
+        value = obj.__dict__[self.name] = resolver.resolve(obj, self.name)
+        return value
+
+
 # in .models.entity
 class Entity(object):
+    accessList = lazy('accessList')
+
     def __repr__(self):
         return "<%s id=%d>" % (self.__class__.__name__, self.id)
 
-class ChildEntity(Entity): pass
+class ChildEntity(Entity):
+    parent = lazy('parent')
+
 class FileSystemEntity(ChildEntity): pass
 class Comment(ChildEntity): pass
 class ThumbnailImage(FileSystemEntity): pass
 
 
 # in .models.item
-class Item(FileSystemEntity): pass
-class AlbumItem(Item): pass
+class Item(FileSystemEntity):
+    owner = lazy('owner')
+    subitems = lazy('subitems')
+    comments = lazy('comments')
+    linked_item = lazy('linked_item')
+    linked_from_item = lazy('linked_from_item')
+
+class AlbumItem(Item):
+    hilight = lazy('hilight')
+
 class PhotoItem(Item): pass
 class MovieItem(Item): pass
 class LinkItem(Item): pass
@@ -29,9 +66,15 @@ class DataItem(Item): pass
 class UnknownItem(Item): pass
 
 # in .models.access
-class User(Entity): pass
-class Group(Entity): pass
-class AccessMap(object): pass
+class User(Entity):
+    groups = lazy('groups')
+
+class Group(Entity):
+    users = lazy('users')
+
+class AccessMap(object):
+    userOrGroup = lazy('userOrGroup')
+
 class AccessSubscriberMap(object): pass
 
 # in .models.derivative
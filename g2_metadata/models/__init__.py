@@ -15,6 +15,8 @@ from .entity import (
 from .access import (
     User,
     Group,
+    AccessMap,
+    AccessSubscriberMap,
     )
 from .derivative import (
     Derivative,
@@ -29,7 +31,11 @@ from .item import (
     AnimationItem,
     DataItem,
     UnknownItem,
+    get_derivative_prefs,
+    get_hilight_ids,
+    load_subitems,
     )
 from .plugin import (
     get_global_plugin_parameters,
+    get_plugin_parameters,
     )
@@ -49,6 +49,9 @@ class Base(object):
         items = [(attr, getattr(self, attr))
                  for attr in self.__yaml_attributes__
                  if attr not in omit_attrs]
+        filter_items = getattr(dumper, 'filter_items', None)
+        if filter_items is not None:
+            items = filter_items(self, items)
         return dumper.represent_mapping(tag, items, False)
 
 Base = declarative_base(cls=Base)
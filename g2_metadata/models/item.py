@@ -6,6 +6,7 @@ These represent actual nodes in the gallery: albums, photos, etc...
 """
 from __future__ import absolute_import
 
+from collections import defaultdict
 from itertools import groupby
 from operator import attrgetter
 
@@ -15,9 +16,11 @@ from sqlalchemy import (
     Integer,
     String,
     Text,
+    inspect,
     text,
     )
 from sqlalchemy.orm import object_session, relationship
+from sqlalchemy.orm.attributes import set_committed_value
 
 from .base import metadata, g_Column, g_Table
 from .entity import FileSystemEntity
@@ -127,13 +130,8 @@ class AlbumItem(Item, PluginParametersMixin):
     # Only AlbumItems appear to have derivative prefs
     @property
     def derivative_prefs(self):
-        session = object_session(self)
-        c = t_DerivativePrefsMap.c
-        q = session.query(t_DerivativePrefsMap).filter_by(itemId=self.id)
-        q = q.order_by(c.derivativeType, c.order)
-        return dict(
-            (dtype, [pref.derivativeOperations for pref in prefs])
-            for dtype, prefs in groupby(q, attrgetter('derivativeType')))
+        prefs = get_derivative_prefs(object_session(self), [self.id])
+        return prefs.get(self.id, {})
 
 
 class PhotoItem(Item):
@@ -186,3 +184,108 @@ class UnknownItem(Item):
 
     id = Column(ForeignKey(Item.id), primary_key=True,
                 server_default=text("'0'"))
+
+
+def get_hilight_ids(session, album_ids):
+    """ Find the hilights of the albums with ids ``album_ids`` (as
+    ``AlbumItem.hilight`` does), with one query, plus one for each
+    level of derivatives sourced from other derivatives.
+
+    Returns a dict mapping album id to the id of its hilight.  Albums
+    without a hilight are omitted.
+    """
+    hilight_ids = {}
+    query = (session.query(Derivative.parentId,
+                           Derivative.derivativeSourceId)
+             .filter(Derivative.parentId.in_(album_ids)))
+    for album_id, source_id in query:
+        if album_id in hilight_ids:
+            raise ValueError("album %d has more than one derivative"
+                             % album_id)
+        hilight_ids[album_id] = source_id
+    sources = set(hilight_ids.values())
+    while sources:
+        derived = dict(session.query(Derivative.id,
+                                     Derivative.derivativeSourceId)
+                       .filter(Derivative.id.in_(sources)))
+        for album_id, source_id in hilight_ids.items():
+            if source_id in derived:
+                hilight_ids[album_id] = derived[source_id]
+        sources = set(derived.values())
+    return hilight_ids
+
+
+def get_derivative_prefs(session, item_ids):
+    """ Get the derivative prefs of the items with ids ``item_ids``.
+
+    Returns a dict mapping item id to the item's derivative prefs.
+    Items without derivative prefs are omitted.
+    """
+    c = t_DerivativePrefsMap.c
+    q = session.query(t_DerivativePrefsMap).filter(c.itemId.in_(item_ids))
+    q = q.order_by(c.itemId, c.derivativeType, c.order)
+    return dict(
+        (item_id, dict(
+            (dtype, [pref.derivativeOperations for pref in prefs])
+            for dtype, prefs in groupby(item_prefs,
+                                        attrgetter('derivativeType'))))
+        for item_id, item_prefs in groupby(q, attrgetter('itemId')))
+
+
+def load_subitems(session, parents, chunk_size=500):
+    """ Load the ``subitems`` of all of ``parents`` (those not already
+    loaded), with one query per ``chunk_size`` parents.
+
+    This can be used as the ``prefetch`` hook of
+    ``g2_metadata.traversal.walk``, to walk the tree with one query per
+    level (rather than one per album.)
+    """
+    parents = [parent for parent in parents
+               if 'subitems' in inspect(parent).unloaded]
+    subitems = defaultdict(list)
+    for start in range(0, len(parents), chunk_size):
+        parent_ids = [parent.id for parent in
+                      parents[start:start + chunk_size]]
+        query = (session.query(Item)
+                 .with_polymorphic('*')
+                 .filter(Item.parentId.in_(parent_ids))
+                 .order_by(Item.parentId, Item.orderWeight))
+        for item in query:
+            subitems[item.parentId].append(item)
+    for parent in parents:
+        children = subitems.get(parent.id, [])
+        set_committed_value(parent, 'subitems', children)
+        for child in children:
+            if 'parent' in inspect(child).unloaded:
+                set_committed_value(child, 'parent', parent)
+
+
+def test_load_subitems():
+    from functools import partial
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+    from ..standin import create_engine, sample_gallery
+    from ..traversal import walk
+
+    engine = create_engine()
+    sample_gallery(engine)
+    queries = []
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, *args):
+        queries.append(statement)
+
+    def walk_ids(prefetch=False):
+        session = Session(bind=engine)
+        root = session.query(Item).get(1)
+        del queries[:]
+        if prefetch:
+            prefetch = partial(load_subitems, session)
+        return [item.id for item in walk(root, prefetch=prefetch or None)]
+
+    # one lazy load per album...
+    assert walk_ids() == [1, 2, 5, 6, 3, 4]
+    assert len(queries) == 3
+    # ... or one query per level
+    assert walk_ids(prefetch=True) == [1, 2, 5, 6, 3, 4]
+    assert len(queries) == 2
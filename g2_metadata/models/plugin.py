@@ -69,6 +69,24 @@ def get_global_plugin_parameters(session):
         session.query(PluginParameterMap).filter_by(itemId=0))
 
 
+def get_plugin_parameters(session, item_ids):
+    """ Get the plugin parameters of the entities with ids ``item_ids``
+    (as their ``plugin_parameters`` would.)
+
+    Returns a dict mapping id to nested dict.  Entities without plugin
+    parameters are omitted.
+    """
+    parameters = (session.query(PluginParameterMap)
+                  .filter(PluginParameterMap.itemId.in_(item_ids))
+                  .order_by(PluginParameterMap.itemId,
+                            PluginParameterMap.pluginType,
+                            PluginParameterMap.pluginId))
+    return dict(
+        (item_id, _plugin_parameters_to_dict(item_parameters))
+        for item_id, item_parameters in groupby(parameters,
+                                                attrgetter('itemId')))
+
+
 def _plugin_parameters_to_dict(plugin_parameters):
     """ Convert a sequence of ``PluginParamterMap`` instances to nested dict.
 
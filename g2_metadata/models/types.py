@@ -2,10 +2,19 @@
 from __future__ import absolute_import
 
 from calendar import timegm
-from datetime import datetime
+from datetime import datetime, timedelta
+import re
 
 import sqlalchemy as sa
 
+EPOCH = datetime(1970, 1, 1)
+
+
+def _chain(impl_processor, process):
+    if impl_processor is None:
+        return process
+    return lambda value: process(impl_processor(value))
+
 
 class Timestamp(sa.TypeDecorator):
     """A datetime.datetime column.
@@ -25,7 +34,17 @@ class Timestamp(sa.TypeDecorator):
     def process_result_value(self, value, dialect):
         if value is None or value == -1:
             return None
-        return datetime.utcfromtimestamp(value)
+        return EPOCH + timedelta(seconds=value)
+
+    def result_processor(self, dialect, coltype):
+        # This is called once per dialect.  The processor it returns is
+        # called for every value fetched, so avoid method calls and
+        # attribute lookups there.
+        def process(value, epoch=EPOCH, timedelta=timedelta):
+            if value is None or value == -1:
+                return None
+            return epoch + timedelta(seconds=value)
+        return _chain(self.impl.result_processor(dialect, coltype), process)
 
 
 class MangledBase(object):
@@ -41,16 +60,34 @@ class MangledBase(object):
 
     def process_bind_param(self, value, dialect):
         if value:
-            for orig, repl in self.MANGLED:
+            # NB: '&' must be escaped first
+            for orig, repl in reversed(self.MANGLED):
                 value = value.replace(orig, repl)
         return value
 
+    UNMANGLE_RE = re.compile('|'.join(re.escape(repl)
+                                      for orig, repl in MANGLED))
+    UNMANGLED = dict((repl, orig) for orig, repl in MANGLED)
+
     def process_result_value(self, value, dialect):
-        if value:
-            for orig, repl in self.MANGLED:
-                value = value.replace(repl, orig)
+        if value and '&' in value:
+            unmangled = self.UNMANGLED
+            value = self.UNMANGLE_RE.sub(
+                lambda m: unmangled[m.group()], value)
         return value
 
+    def result_processor(self, dialect, coltype):
+        # Called once per dialect.  See Timestamp.result_processor.
+        sub = self.UNMANGLE_RE.sub
+        unmangle = (lambda m, unmangled=self.UNMANGLED:
+                    unmangled[m.group()])
+
+        def process(value):
+            if value and '&' in value:
+                return sub(unmangle, value)
+            return value
+        return _chain(self.impl.result_processor(dialect, coltype), process)
+
 
 class MangledString(MangledBase, sa.TypeDecorator):
     impl = sa.String
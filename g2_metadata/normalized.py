@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+""" The normalized metadata layout.
+
+In the nested layout (the original one) the whole gallery is a single
+YAML document: items are nested under ``album.subitems`` and shared
+objects (owners, access lists, ...) are emitted inline and referenced
+by YAML aliases.  The YAML loader must resolve the whole thing at once.
+
+In the normalized layout, the gallery is a sequence of flat records.
+The first record is a *header* containing the tables of users, groups,
+access lists and the global plugin parameters.  Every following record
+describes a single item or comment.  Records refer to each other by id
+(``parentId``, ``ownerId``, ``accessListId``, ``linkId``,
+``hilightId``, ``groupIds``, ``userOrGroupId``).
+
+The normalized layout may also be sharded into a directory of files.
+The index file contains the header, followed by the records of the root
+album and the top-level items; the header's ``shards`` maps the id of
+each top-level album to the name of the file holding the records of all
+its descendants, and ``item_shards`` maps the id of each of those
+descendants to the id of its top-level album.
+
+The loader in this module builds ``g2_metadata.meta`` instances from
+those records on demand, resolving references lazily.  When loading,
+each item's record is dropped from the store once its instance has been
+built, so that items are not held twice.
+
+"""
+from __future__ import absolute_import
+
+from collections import defaultdict, Mapping
+import os
+
+from . import meta
+
+LAYOUT = 'normalized'
+SHARD_INDEX = 'index.yml'
+
+HEADER_KEYS = ('groups', 'users', 'plugin_parameters')
+
+
+class RecordStore(object):
+    """ An in-memory store of the records of a normalized dump.
+
+    """
+    def __init__(self, header):
+        self.header = header
+        self.items = {}
+        self.paths = {}
+        self.children = defaultdict(list)
+        self.linked_from = defaultdict(list)
+        self.comments = defaultdict(list)
+
+    def add(self, record):
+        if record['class'] == 'Comment':
+            self.comments[record['parentId']].append(record)
+        else:
+            item_id = record['id']
+            self.items[item_id] = record
+            self.paths[record['path']] = item_id
+            self.children[record['parentId']].append(item_id)
+            if record.get('linkId'):
+                self.linked_from[record['linkId']].append(item_id)
+
+    def remove(self, item_id):
+        """ Remove the record for an item, and those for its comments.
+
+        Returns the removed item record, or ``None``.
+        """
+        record = self.items.pop(item_id, None)
+        if record is not None:
+            if self.paths.get(record['path']) == item_id:
+                del self.paths[record['path']]
+            _discard(self.children.get(record['parentId']), item_id)
+            if record.get('linkId'):
+                _discard(self.linked_from.get(record['linkId']), item_id)
+            self.comments.pop(item_id, None)
+        return record
+
+    def replace(self, record):
+        """ Add, or replace, the record for an item.
+
+        The comments for the item are removed.  The item is placed in
+        order (by ``orderWeight``) among its siblings.
+        """
+        self.remove(record['id'])
+        self.add(record)
+        items = self.items
+        self.children[record['parentId']].sort(key=lambda item_id: (
+            items[item_id].get('orderWeight') is not None,
+            items[item_id].get('orderWeight'),
+            item_id))
+
+    def release(self, item_id):
+        """ Drop the record for an item (whose instance has been built.)
+
+        Its place in the tree (path, parent and links) is kept.
+        """
+        self.items.pop(item_id, None)
+
+    def get_item(self, item_id):
+        return self.items.get(item_id)
+
+    def get_item_id_by_path(self, path):
+        return self.paths.get(path)
+
+    def get_item_by_path(self, path):
+        item_id = self.get_item_id_by_path(path)
+        if item_id is not None:
+            return self.get_item(item_id)
+
+    def get_children(self, item_id):
+        return self.children.get(item_id, ())
+
+    def get_comments(self, item_id):
+        return self.comments.get(item_id, ())
+
+    def get_linked_from(self, item_id):
+        return self.linked_from.get(item_id, ())
+
+
+def _discard(item_ids, item_id):
+    if item_ids and item_id in item_ids:
+        item_ids.remove(item_id)
+
+
+class ShardedRecordStore(RecordStore):
+    """ A record store which loads the shards of a sharded dump on demand.
+
+    ``read_records`` is called with the path to a shard file, and should
+    return an iterable of the records in it.
+
+    When pickled, all the shards are loaded first, so that the pickle
+    does not depend on the shard files.
+
+    """
+    def __init__(self, header, shard_dir, read_records):
+        super(ShardedRecordStore, self).__init__(header)
+        self.shard_dir = shard_dir
+        self.read_records = read_records
+        self.pending = dict(header.get('shards') or {})
+        # (Dumps made before item_shards was added do not have it)
+        self.item_shards = header.get('item_shards')
+
+    def __getstate__(self):
+        self.load_all()
+        state = self.__dict__.copy()
+        state.update(shard_dir=None, read_records=None)
+        return state
+
+    def load_shard(self, album_id):
+        filename = self.pending.pop(album_id, None)
+        if filename is not None:
+            self.add_shard(self.read_records(
+                os.path.join(self.shard_dir, filename)))
+
+    def add_shard(self, records):
+        for record in records:
+            self.add(record)
+
+    def load_all(self):
+        for album_id in list(self.pending):
+            self.load_shard(album_id)
+
+    def get_item(self, item_id):
+        if item_id not in self.items and self.pending:
+            if self.item_shards is not None:
+                album_id = self.item_shards.get(item_id)
+                if album_id is not None:
+                    self.load_shard(album_id)
+            else:
+                while item_id not in self.items and self.pending:
+                    self.load_shard(next(iter(self.pending)))
+        return self.items.get(item_id)
+
+    def get_item_id_by_path(self, path):
+        top_level = self.paths.get(path.split('/', 1)[0])
+        if top_level is not None:
+            self.load_shard(top_level)
+        return super(ShardedRecordStore, self).get_item_id_by_path(path)
+
+    def get_children(self, item_id):
+        self.load_shard(item_id)
+        return super(ShardedRecordStore, self).get_children(item_id)
+
+    def get_linked_from(self, item_id):
+        self.load_all()
+        return super(ShardedRecordStore, self).get_linked_from(item_id)
+
+
+class NormalizedMetadata(Mapping):
+    """ Gallery metadata loaded from a normalized layout.
+
+    This quacks like the ``dict`` loaded from the nested YAML layout
+    (it has ``groups``, ``users``, ``plugin_parameters`` and ``album``
+    keys), but items are only constructed when they are reached.  It
+    also supports random access to items by id or by path.
+
+    If ``release`` is set, records are released from the store once
+    their items have been built.
+
+    """
+    def __init__(self, records, release=False):
+        self.records = records
+        self.release = release
+        self._entities = {}
+        self._access_lists = {}
+
+        header = records.header
+        self.groups = [self._construct(record)
+                       for record in header.get('groups', ())]
+        self.users = [self._construct(record)
+                      for record in header.get('users', ())]
+        self.plugin_parameters = header.get('plugin_parameters')
+
+    def __getitem__(self, key):
+        if key == 'album':
+            return self.item(self.records.header['root'])
+        elif key in HEADER_KEYS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(HEADER_KEYS + ('album',))
+
+    def __len__(self):
+        return len(HEADER_KEYS) + 1
+
+    def _construct(self, record):
+        cls = getattr(meta, record['class'])
+        assert isinstance(cls, type)
+        obj = cls.__new__(cls)
+        obj.__dict__.update(
+            (key, value) for key, value in record.items() if key != 'class')
+        obj._resolver = self
+        if isinstance(obj, meta.Entity):
+            self._entities[obj.id] = obj
+        return obj
+
+    def entity(self, entity_id):
+        """ Get the user, group or item with the given id.
+        """
+        if not entity_id:
+            return None
+        obj = self._entities.get(entity_id)
+        if obj is None:
+            record = self.records.get_item(entity_id)
+            if record is not None:
+                obj = self._construct(record)
+                if self.release:
+                    self.records.release(entity_id)
+        return obj
+
+    item = entity
+
+    def item_by_path(self, path):
+        """ Get the item with the given path (relative to the albums root.)
+        """
+        item_id = self.records.get_item_id_by_path(path)
+        if item_id is not None:
+            return self.entity(item_id)
+
+    def access_list(self, access_list_id):
+        # Identical access lists are the same list, as they are when
+        # loaded from the nested layout.
+        if access_list_id is None:
+            return []
+        access_list = self._access_lists.get(access_list_id)
+        if access_list is None:
+            entries = self.records.header['access_lists'].get(access_list_id)
+            access_list = []
+            for entry in entries or ():
+                record = dict(entry, accessListId=access_list_id)
+                record['class'] = 'AccessMap'
+                access_list.append(self._construct(record))
+            self._access_lists[access_list_id] = access_list
+        return access_list
+
+    def resolve(self, obj, name):
+        """ Resolve reference attribute ``name`` of ``obj``.
+
+        This is called by ``g2_metadata.meta.lazy``.
+        """
+        return getattr(self, '_resolve_' + name)(obj)
+
+    def _resolve_accessList(self, obj):
+        return self.access_list(obj.__dict__.get('accessListId'))
+
+    def _resolve_parent(self, obj):
+        return self.entity(obj.parentId)
+
+    def _resolve_owner(self, obj):
+        return self.entity(obj.ownerId)
+
+    def _resolve_subitems(self, obj):
+        return [self.entity(item_id)
+                for item_id in self.records.get_children(obj.id)]
+
+    def _resolve_comments(self, obj):
+        return [self._construct(record)
+                for record in self.records.get_comments(obj.id)]
+
+    def _resolve_linked_item(self, obj):
+        return self.entity(obj.linkId)
+
+    def _resolve_linked_from_item(self, obj):
+        return [self.entity(item_id)
+                for item_id in self.records.get_linked_from(obj.id)]
+
+    def _resolve_hilight(self, obj):
+        return self.entity(obj.__dict__.get('hilightId'))
+
+    def _resolve_groups(self, obj):
+        return [self.entity(group_id) for group_id in obj.groupIds]
+
+    def _resolve_users(self, obj):
+        return [user for user in self.users if obj.id in user.groupIds]
+
+    def _resolve_userOrGroup(self, obj):
+        return self.entity(obj.userOrGroupId)
+
+
+def load_records(header, records):
+    """ Build ``NormalizedMetadata`` from a header and an iterable of
+    item and comment records.
+
+    """
+    store = RecordStore(header)
+    for record in records:
+        store.add(record)
+    return NormalizedMetadata(store, release=True)
+
+
+def test_load_records():
+    header = {
+        'layout': LAYOUT,
+        'root': 1,
+        'users': [{'class': 'User', 'id': 9, 'userName': 'u',
+                   'groupIds': [8]}],
+        'groups': [{'class': 'Group', 'id': 8, 'groupName': 'g'}],
+        'access_lists': {5: [{'userOrGroupId': 8, 'permission': 7}]},
+        'plugin_parameters': None,
+        }
+
+    def item(cls, item_id, parent_id, path, **kw):
+        record = {'class': cls, 'id': item_id, 'parentId': parent_id,
+                  'path': path, 'ownerId': 9, 'accessListId': 5,
+                  'linkId': None}
+        record.update(kw)
+        return record
+
+    records = [
+        item('AlbumItem', 1, 0, ''),
+        item('AlbumItem', 2, 1, 'a'),
+        item('PhotoItem', 3, 2, 'a/p.jpg'),
+        item('LinkItem', 4, 1, 'l.jpg', linkId=3),
+        {'class': 'Comment', 'id': 6, 'parentId': 3, 'text': 'c'},
+        ]
+    g2data = load_records(header, iter(records))
+    store = g2data.records
+    root = g2data['album']
+    assert root.id == 1 and set(store.items) == set([2, 3, 4])
+    album, link = root.subitems
+    assert set(store.items) == set([3])
+    assert album.parent is root and album.path == 'a'
+    photo, = album.subitems
+    assert not store.items
+    assert link.linked_item is photo
+    assert photo.linked_from_item == [link]
+    assert [comment.text for comment in photo.comments] == ['c']
+    assert photo.owner is g2data['users'][0]
+    assert photo.owner.groups == g2data['groups']
+    assert photo.accessList is album.accessList
+    assert photo.accessList[0].userOrGroup is g2data['groups'][0]
+    assert g2data.item_by_path('a/p.jpg') is photo
+    assert g2data.item(3) is photo
+    assert g2data.item_by_path('missing') is None
+    assert g2data.item(99) is None
+
+
+def test_sharded_record_store():
+    import pickle
+
+    def item(item_id, parent_id, path):
+        return {'class': 'AlbumItem', 'id': item_id, 'parentId': parent_id,
+                'path': path}
+
+    shards = {
+        'album-2.yml': [item(4, 2, 'a/x'), item(5, 4, 'a/x/y')],
+        'album-3.yml': [item(6, 3, 'b/z')],
+        }
+    loaded = []
+
+    def read_records(path):
+        loaded.append(os.path.basename(path))
+        return shards[os.path.basename(path)]
+
+    header = {'root': 1,
+              'shards': {2: 'album-2.yml', 3: 'album-3.yml'},
+              'item_shards': {4: 2, 5: 2, 6: 3}}
+    store = ShardedRecordStore(header, 'shards', read_records)
+    store.add_shard([item(1, 0, ''), item(2, 1, 'a'), item(3, 1, 'b')])
+    assert store.get_item(99) is None and loaded == []
+    assert store.get_item(5)['path'] == 'a/x/y'
+    assert loaded == ['album-2.yml']
+    assert store.get_item_by_path('b/z')['id'] == 6
+    assert loaded == ['album-2.yml', 'album-3.yml']
+
+    store = ShardedRecordStore(header, 'shards', read_records)
+    store = pickle.loads(pickle.dumps(store))
+    assert not store.pending and store.read_records is None
+    assert store.get_item(6)['path'] == 'b/z'
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+""" Scanning text for markup.
+
+The patterns are compiled once, here, and shared by the markup
+conversions.  ``classify`` finds newlines, bbcode tags and HTML
+entities in a single pass over the text.
+
+"""
+from __future__ import absolute_import
+
+import re
+
+NEWLINE = 1
+BBCODE = 2
+ENTITY = 4
+ALL = NEWLINE | BBCODE | ENTITY
+
+# A newline, and the whitespace around it
+NEWLINE_RE = re.compile(r'\s*?[\n\r]\s*')
+
+# Anything the bbcode parser might take for a tag: a (single line)
+# bracketed tag name, or closing tag name, possibly with options
+_BBCODE_TAG = r'\[[^\S\n\r]*/?[^\S\n\r]*[\w*][^\n\r]*?\]'
+BBCODE_TAG_RE = re.compile(_BBCODE_TAG, re.UNICODE)
+
+_ENTITY = r'&(?:[A-Za-z][A-Za-z0-9]*|#[0-9]+|#[xX][0-9A-Fa-f]+);'
+ENTITY_RE = re.compile(_ENTITY)
+
+_MARKUP_RE = re.compile(
+    r'(?P<newline>[\n\r])|(?P<bbcode>%s)|(?P<entity>%s)'
+    % (_BBCODE_TAG, _ENTITY),
+    re.UNICODE)
+
+_FLAGS = {
+    'newline': NEWLINE,
+    'bbcode': BBCODE,
+    'entity': ENTITY,
+    }
+
+
+def classify(text):
+    """ Find the markup in ``text``.
+
+    Returns the bitwise or of ``NEWLINE``, ``BBCODE`` and ``ENTITY``, for
+    each kind of markup found.
+    """
+    found = 0
+    if text:
+        for match in _MARKUP_RE.finditer(text):
+            found |= _FLAGS[match.lastgroup]
+            if found == ALL:
+                break
+    return found
+
+
+def test_classify():
+    assert classify(u'') == 0
+    assert classify(None) == 0
+    assert classify(u'Plain (2005) text') == 0
+    assert classify(u'one\r\ntwo') == NEWLINE
+    assert classify(u'[b]bold[/b]') == BBCODE
+    assert classify(u'list\n[*] item') == NEWLINE | BBCODE
+    assert classify(u'[ /i ]') == BBCODE
+    assert classify(u'[url\n]') == NEWLINE
+    assert classify(u'Fish &amp; chips') == ENTITY
+    assert classify(u'&#233;t&#xE9;\n[i]x[/i]') == ALL
@@ -6,19 +6,37 @@
 """
 from __future__ import absolute_import
 
-from collections import OrderedDict, deque
+from collections import OrderedDict
 import io
+from itertools import chain
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 
 from six import text_type
 
 from .. import meta
 from ..markup import bbcode_to_markdown, strip_bbcode, strip_nl
-from ..util import text_, walk_items
+from ..traversal import DFS, walk
+from ..util import text_
+from . import summary
+from .checkpoint import walk_subtrees
+from .dircache import DirectoryCache
+from .manifest import update_hidden_manifest, write_hidden_manifest
+from .sync import (
+    find_foreign_symlinks,
+    find_orphans,
+    index_albums,
+    remove_orphans,
+    report_foreign_symlinks,
+    )
+from .writer import AtomicWriter
 
 log = logging.getLogger(__name__)
 
+# Number of items written between checkpoints
+CHECKPOINT_INTERVAL = 1000
+
 
 def write_markdown(stream, md_text, metadata={}):
     for key, value in metadata.items():
@@ -39,20 +57,61 @@ def zulu(dt):
 
 
 class SigalMetadata(object):
-    def __init__(self, g2data, albums_path, item):
+    def __init__(self, g2data, albums_path, item, normalize=False,
+                 fs=None, writer=None):
         self.g2data = g2data
         self.albums_path = albums_path
         self.item = item
         self.target = item.path
+        self.normalize = normalize
+        self.fs = fs if fs is not None else DirectoryCache()
+        self.writer = writer if writer is not None else AtomicWriter()
 
     @property
     def target_path(self):
         return os.path.join(self.albums_path, self.target)
 
+    def render(self):
+        metadata = self.metadata
+        description = self.description
+        if self.normalize:
+            description = self.normalize_metadata(metadata, description)
+        buf = io.StringIO()
+        write_markdown(buf, description, metadata)
+        return buf.getvalue()
+
     def write_metadata(self):
         md_path = os.path.join(self.albums_path, self.md_path)
-        with io.open(md_path, 'w', encoding='utf-8') as fp:
-            write_markdown(fp, self.description, self.metadata)
+        # (Keep the permissions of an existing file)
+        self.writer.write(md_path, self.render().encode('utf-8'),
+                          self.fs.mode(md_path))
+
+    @property
+    def sigal_path(self):
+        # The path the normalize_summary plugin sees as ``item.path``
+        return self.target or '.'
+
+    def normalize_metadata(self, metadata, description):
+        """ Apply the rules of the ``normalize_summary`` plugin.
+
+        This updates ``metadata`` in place, and returns the normalized
+        description.
+        """
+        def text(value):
+            # as sigal would read it
+            return strip_nl(text_type(value)).strip() if value else u''
+
+        title, normalized = summary.normalize(
+            text(metadata.get('title')),
+            text(metadata.get('summary')),
+            description.strip(),
+            summary.Canonizer(self.sigal_path))
+        if title or 'title' in metadata:
+            metadata['title'] = title
+        metadata[summary.NORMALIZED] = 'yes'
+        if normalized != description.strip():
+            description = normalized
+        return description
 
     @property
     def description(self):
@@ -100,13 +159,18 @@ class SigalMetadata(object):
 
     def check_target(self):
         target_path = self.target_path
-        if not os.path.exists(target_path):
+        if not self.fs.exists(target_path):
             log.error("%s: target does not exist", self.target)
-        elif not os.access(target_path, os.R_OK):
+        elif not self.fs.readable(target_path):
             log.warning("%s: is not readable", self.target)
 
 
 class SigalImageHelper(SigalMetadata):
+    @property
+    def sigal_path(self):
+        # Sigal's Media.path is the path of the containing album
+        return os.path.dirname(self.target) or '.'
+
     @property
     def md_path(self):
         base, ext = os.path.splitext(self.target)
@@ -117,18 +181,19 @@ class SigalImageHelper(SigalMetadata):
         link = self.item.linked_item.path
         link_path = os.path.join(self.albums_path, link)
 
-        if not os.path.exists(target_path):
+        if not self.fs.exists(target_path):
             # Create symlink
-            if os.path.isfile(link_path):
+            if self.fs.isfile(link_path):
                 link_relpath = os.path.relpath(link_path,
                                                os.path.dirname(target_path))
                 log.info("%s: creating symlink link to %s",
                          self.target, link_relpath)
                 os.symlink(link_relpath, target_path)
+                self.fs.update(target_path)
             else:
                 log.error("%s: link target %s is not a regular file",
                           self.target, link)
-        elif not os.path.islink(target_path):
+        elif not self.fs.islink(target_path):
             log.warning("%s: not a symlink", self.target)
 
     def check_target(self):
@@ -149,12 +214,9 @@ class SigalAlbumHelper(SigalMetadata):
         order, for one that has an explicit or implicit hilight.
 
         """
-        traverse = deque([self.item])
-        while traverse:
-            item = traverse.popleft()
+        for item in walk(self.item, order=DFS):
             if item.hilight:
                 return item.hilight
-            traverse.extendleft(reversed(item.subitems))
 
     @property
     def metadata(self):
@@ -166,7 +228,7 @@ class SigalAlbumHelper(SigalMetadata):
             # album)?
             hilight_path = os.path.join(self.albums_path, hilight.path)
             thumbnail = os.path.relpath(hilight_path, self.target_path)
-            if not os.path.exists(hilight_path):
+            if not self.fs.exists(hilight_path):
                 log.warning("%s: thumbnail %s does not exist",
                             self.target, thumbnail)
             data['thumbnail'] = thumbnail
@@ -189,22 +251,132 @@ class SigalAlbumHelper(SigalMetadata):
         return data
 
     def check_target(self):
-        if not os.path.isdir(self.target_path):
+        if not self.fs.isdir(self.target_path):
             log.error("%s: not a directory", self.target)
         else:
             super(SigalAlbumHelper, self).check_target()
 
 
-def write_metadata(g2data, albums_path):
-    album = g2data['album']
-    for item in walk_items(album):
-        if isinstance(item, meta.AlbumItem):
-            helper = SigalAlbumHelper(g2data, albums_path, item)
-        elif isinstance(item, (meta.PhotoItem, meta.MovieItem)):
-            helper = SigalImageHelper(g2data, albums_path, item)
-        else:
-            log.warning("Do not know how to handle %r.  Ignoring..." % item)
+def _helper(g2data, albums_path, item, normalize, fs, writer):
+    if isinstance(item, meta.AlbumItem):
+        return SigalAlbumHelper(g2data, albums_path, item, normalize, fs,
+                                writer)
+    elif isinstance(item, (meta.PhotoItem, meta.MovieItem)):
+        return SigalImageHelper(g2data, albums_path, item, normalize, fs,
+                                writer)
+    log.warning("Do not know how to handle %r.  Ignoring..." % item)
+
+
+def _write_items(g2data, albums_path, items, normalize, fs, writer):
+    """ Check the targets of, and write the metadata for, ``items``.
+
+    Generates the helpers used.
+    """
+    for item in items:
+        helper = _helper(g2data, albums_path, item, normalize, fs, writer)
+        if helper is None:
             continue
+        if isinstance(item, meta.AlbumItem):
+            fs.prefetch(os.path.join(albums_path, item.path))
         log.debug("Processing {0.path}".format(item))
         helper.check_target()
         helper.write_metadata()
+        yield helper
+
+
+def _checkpointed_items(album, journal, writer, skipped,
+                        interval=CHECKPOINT_INTERVAL):
+    """ Generate the items under ``album`` (depth first), skipping the
+    subtrees which ``journal`` records as done.
+
+    Completed subtrees are recorded in ``journal`` after (about) every
+    ``interval`` items, once ``writer`` has been flushed.  The roots of
+    skipped subtrees are appended to ``skipped``.
+    """
+    finished = []
+    count = 0
+    for item, subtree in walk_subtrees(album, journal.is_done):
+        if item is not None:
+            yield item
+            count += 1
+        elif journal.is_done(subtree):
+            skipped.append(subtree)
+        else:
+            finished.append(subtree)
+            if count >= interval:
+                writer.flush()
+                journal.record(finished)
+                finished = []
+                count = 0
+    writer.flush()
+    journal.record(finished)
+
+
+def write_metadata(g2data, albums_path, normalize=False, jobs=None,
+                   sync=False, dry_run=False, root=None, journal=None):
+    """ Write sigal metadata for each item in ``g2data`` (or, if ``root``
+    is given, for each item in the subtree under that album.)
+
+    The album directories are scanned, to check that the targets exist,
+    and the metadata files are written, in ``jobs`` threads, if given.
+
+    If ``sync`` is set, ``.md`` files and symlinks which do not belong
+    to any item are removed (or, if ``dry_run`` is set, reported.)
+
+    If a ``journal`` (see ``g2_metadata.sigal.checkpoint``) is given,
+    completed album subtrees are recorded in it, and subtrees it already
+    records are skipped.
+    """
+    album = root if root is not None else g2data['album']
+    pool = ThreadPool(jobs) if jobs and jobs > 1 else None
+    fs = DirectoryCache(pool)
+    if sync:
+        index = index_albums(albums_path, fs, album.path)
+        md_paths = set()
+        targets = set()
+    fs.prefetch(os.path.dirname(os.path.normpath(albums_path)))
+    try:
+        with AtomicWriter(jobs) as writer:
+            skipped = []
+            if journal is None:
+                items = walk(album, order=DFS)
+            else:
+                items = _checkpointed_items(album, journal, writer, skipped)
+            helpers = _write_items(g2data, albums_path, items, normalize,
+                                   fs, writer)
+            for helper in helpers:
+                if sync:
+                    md_paths.add(helper.md_path)
+                    targets.add(helper.target)
+            if sync:
+                # The files in skipped subtrees are not orphans
+                for item in chain.from_iterable(map(walk, skipped)):
+                    helper = _helper(g2data, albums_path, item, normalize,
+                                     fs, writer)
+                    if helper is not None:
+                        md_paths.add(helper.md_path)
+                        targets.add(helper.target)
+            if album.path:
+                # only a subtree (possibly from a subtree dump)
+                update_hidden_manifest(album, albums_path, writer)
+            else:
+                write_hidden_manifest(album, albums_path, writer)
+        if sync:
+            report_foreign_symlinks(find_foreign_symlinks(index, targets))
+            orphans = find_orphans(index, md_paths, targets)
+            remove_orphans(albums_path, orphans, dry_run, fs)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def write_items(g2data, albums_path, items, normalize=False):
+    """ Write sigal metadata for just ``items``.
+
+    Returns the paths (relative to ``albums_path``) of the metadata
+    files written.
+    """
+    with AtomicWriter() as writer:
+        helpers = _write_items(g2data, albums_path, items, normalize,
+                               DirectoryCache(), writer)
+        return [helper.md_path for helper in helpers]
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+""" Checkpoints for resuming interrupted ``to-sigal`` runs.
+
+As ``to-sigal`` runs, it records the ids of the albums whose subtrees
+have been completely written in a journal (``.to-sigal.journal`` in
+the albums directory.)  The first line of the journal is the *snapshot
+key*, which identifies the metadata being written (and the options
+which affect the output.)  A resumed run, with the same snapshot key,
+skips the recorded subtrees.  The journal is removed once a run
+completes.
+
+"""
+from __future__ import absolute_import
+
+import hashlib
+import io
+import os
+
+from six import text_type
+
+from .. import meta
+from ..traversal import DFS, walk
+
+JOURNAL = '.to-sigal.journal'
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return st.st_ino, st.st_size, st.st_mtime
+
+
+def snapshot_key(metadata_path, *options):
+    """ Compute a key identifying a metadata snapshot (as read from
+    ``metadata_path``), and the ``options`` it is written with.
+
+    For a sharded dump (a directory), the key covers each of the files
+    in the directory, since they may be rewritten without changing the
+    directory itself.
+    """
+    if os.path.isdir(metadata_path):
+        stats = [(name, _stat_key(os.path.join(metadata_path, name)))
+                 for name in sorted(os.listdir(metadata_path))]
+    else:
+        stats = _stat_key(metadata_path)
+    key = repr((os.path.realpath(metadata_path), stats, options))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class Journal(object):
+    """ The journal of completed album subtrees.
+
+    If ``resume`` is set, and the journal in ``albums_path`` was written
+    for the same snapshot, the subtrees it records are considered done.
+    Otherwise a new journal is started.
+    """
+    def __init__(self, albums_path, snapshot, resume=False):
+        self.path = os.path.join(albums_path, JOURNAL)
+        self.done = set()
+        if resume:
+            self.done = self._read(snapshot)
+        # The journal is rewritten (rather than appended to), in case its
+        # last line is incomplete
+        self.fp = io.open(self.path, 'w', encoding='ascii')
+        self.fp.write(text_type(snapshot) + u'\n')
+        for album_id in sorted(self.done):
+            self.fp.write(u'%d\n' % album_id)
+        self._sync()
+
+    def _read(self, snapshot):
+        try:
+            fp = io.open(self.path, encoding='ascii')
+        except IOError:
+            return set()
+        with fp:
+            lines = fp.read().split('\n')
+        if lines[0] != snapshot:
+            return set()
+        # The last line may be incomplete
+        return set(int(line) for line in lines[1:-1])
+
+    def _sync(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def is_done(self, album):
+        return album.id in self.done
+
+    def record(self, albums):
+        """ Record that the subtrees of ``albums`` have been written.
+        """
+        for album in albums:
+            self.done.add(album.id)
+            self.fp.write(u'%d\n' % album.id)
+        self._sync()
+
+    def close(self, completed=False):
+        self.fp.close()
+        if completed:
+            os.unlink(self.path)
+
+
+def test_snapshot_key(tmpdir):
+    from ..util import atomic_open
+
+    shard_dir = tmpdir.join('shards').ensure(dir=True)
+    shard_dir.join('index.yml').write('index')
+    shard_dir.join('album-2.yml').write('shard')
+    key = snapshot_key(str(shard_dir), False)
+    assert snapshot_key(str(shard_dir), False) == key
+    assert snapshot_key(str(shard_dir), True) != key
+
+    # Rewritten, keeping the directory's (and even the file's) size and
+    # mtime
+    shard = shard_dir.join('album-2.yml')
+    dir_st, st = shard_dir.stat(), shard.stat()
+    with atomic_open(str(shard)) as fp:
+        fp.write('SHARD')
+    os.utime(str(shard), (st.atime, st.mtime))
+    os.utime(str(shard_dir), (dir_st.atime, dir_st.mtime))
+    assert snapshot_key(str(shard_dir), False) != key
+
+
+def test_journal(tmpdir):
+    class Album(object):
+        def __init__(self, id):
+            self.id = id
+
+    journal = Journal(str(tmpdir), u'key')
+    journal.record([Album(12), Album(3)])
+    journal.close()
+    # Interrupted while recording album 45
+    tmpdir.join(JOURNAL).write('4', mode='a')
+
+    journal = Journal(str(tmpdir), u'key', resume=True)
+    assert journal.done == set([3, 12])
+    journal.record([Album(45)])
+    journal.close()
+    assert tmpdir.join(JOURNAL).read() == 'key\n3\n12\n45\n'
+    journal = Journal(str(tmpdir), u'key', resume=True)
+    assert journal.is_done(Album(45)) and not journal.is_done(Album(4))
+    journal.close(completed=True)
+    assert not tmpdir.join(JOURNAL).check()
+
+    tmpdir.join(JOURNAL).write('other\n3\n')
+    journal = Journal(str(tmpdir), u'key', resume=True)
+    assert journal.done == set()
+    journal.close()
+    assert tmpdir.join(JOURNAL).read() == 'key\n'
+
+
+def walk_subtrees(album, skip):
+    """ Walk the items under ``album``, depth first.
+
+    Generates ``(item, None)`` for each item, and ``(None, album)``
+    after the last item in each album's subtree.  Subtrees of albums for
+    which ``skip(album)`` is true are skipped, and generate only
+    ``(None, album)``.
+    """
+    def prune(item):
+        return not isinstance(item, meta.AlbumItem) or skip(item)
+
+    finished = []
+    for item in walk(album, order=DFS, prune=prune, leave=finished.append):
+        for subtree in finished:
+            yield None, subtree
+        del finished[:]
+        if isinstance(item, meta.AlbumItem) and skip(item):
+            yield None, item
+        else:
+            yield item, None
+    for subtree in finished:
+        yield None, subtree
+
+
+def test_walk_subtrees():
+    def item(cls, name, *subitems):
+        obj = cls()
+        obj.__dict__.update(id=name, subitems=list(subitems))
+        return obj
+
+    tree = item(meta.AlbumItem, 'root',
+                item(meta.PhotoItem, 'p1'),
+                item(meta.AlbumItem, 'a1',
+                     item(meta.PhotoItem, 'p2')),
+                item(meta.AlbumItem, 'a2',
+                     item(meta.PhotoItem, 'p3')),
+                item(meta.PhotoItem, 'p4'))
+
+    def walk(skip=()):
+        return [(item and item.id, album and album.id)
+                for item, album in walk_subtrees(
+                    tree, lambda album: album.id in skip)]
+
+    assert walk() == [
+        ('root', None), ('p1', None),
+        ('a1', None), ('p2', None), (None, 'a1'),
+        ('a2', None), ('p3', None), (None, 'a2'),
+        ('p4', None), (None, 'root')]
+    assert walk(skip=['a1']) == [
+        ('root', None), ('p1', None),
+        (None, 'a1'),
+        ('a2', None), ('p3', None), (None, 'a2'),
+        ('p4', None), (None, 'root')]
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+""" A cache of directory listings.
+
+The checks made while writing the sigal metadata (does the target
+exist, is it a directory, is it a symlink, ...) are answered from one
+``scandir`` per directory, rather than from several ``stat`` calls per
+item.  (On network filesystems, each of those is a round trip to the
+server.)
+
+Directory scans may be fanned out over a thread pool.
+
+"""
+from __future__ import absolute_import
+
+import os
+import stat
+
+try:
+    from os import scandir
+except ImportError:                     # pragma: NO COVER
+    # python < 3.5
+    from scandir import scandir
+
+
+def _is_readable(st):
+    """ Approximate ``os.access(path, os.R_OK)`` from a stat result.
+    """
+    euid = os.geteuid()
+    if euid == 0:
+        return True
+    elif st.st_uid == euid:
+        return bool(st.st_mode & stat.S_IRUSR)
+    elif st.st_gid == os.getegid() or st.st_gid in os.getgroups():
+        return bool(st.st_mode & stat.S_IRGRP)
+    return bool(st.st_mode & stat.S_IROTH)
+
+
+class _Entry(object):
+    """ What we know about a directory entry.
+
+    ``isdir``, ``isfile``, ``exists`` and ``mode`` (the permission bits)
+    follow symlinks.
+    """
+    __slots__ = ('exists', 'isdir', 'isfile', 'islink', 'readable', 'mode')
+
+    def __init__(self, exists, isdir, isfile, islink, readable, mode=None):
+        self.exists = exists
+        self.isdir = isdir
+        self.isfile = isfile
+        self.islink = islink
+        self.readable = readable
+        self.mode = mode
+
+    @classmethod
+    def from_stat(cls, st, islink):
+        return cls(True, stat.S_ISDIR(st.st_mode), stat.S_ISREG(st.st_mode),
+                   islink, _is_readable(st), stat.S_IMODE(st.st_mode))
+
+    @classmethod
+    def from_dir_entry(cls, entry):
+        islink = entry.is_symlink()
+        try:
+            st = entry.stat()
+        except OSError:
+            # dangling symlink
+            return cls(False, False, False, islink, False)
+        return cls.from_stat(st, islink)
+
+    @classmethod
+    def from_path(cls, path):
+        try:
+            islink = stat.S_ISLNK(os.lstat(path).st_mode)
+        except OSError:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return cls(False, False, False, islink, False)
+        return cls.from_stat(st, islink)
+
+
+def scan_directory(dirpath):
+    """ List a directory.
+
+    Returns a dict mapping entry names to ``_Entry``\\s.  The listing of
+    a missing (or unreadable) directory is empty.
+    """
+    try:
+        entries = scandir(dirpath)
+    except OSError:
+        return {}
+    return dict((entry.name, _Entry.from_dir_entry(entry))
+                for entry in entries)
+
+
+class DirectoryCache(object):
+    """ Answer questions about paths from cached directory listings.
+
+    If ``pool`` (e.g. a ``multiprocessing.pool.ThreadPool``) is given,
+    directories passed to ``prefetch`` are scanned in the background.
+    """
+    def __init__(self, pool=None):
+        self.pool = pool
+        self.listings = {}
+
+    def prefetch(self, dirpath):
+        """ Start scanning ``dirpath``, if there is a pool to do so.
+        """
+        dirpath = os.path.normpath(dirpath)
+        if self.pool is not None and dirpath not in self.listings:
+            self.listings[dirpath] = self.pool.apply_async(
+                scan_directory, (dirpath,))
+
+    def _listing(self, dirpath):
+        listing = self.listings.get(dirpath)
+        if listing is None:
+            listing = self.listings[dirpath] = scan_directory(dirpath)
+        elif not isinstance(listing, dict):
+            # scan in progress
+            listing = self.listings[dirpath] = listing.get()
+        return listing
+
+    def _entry(self, path):
+        dirpath, name = os.path.split(os.path.normpath(path))
+        dirpath = dirpath or os.curdir
+        if name in ('', os.curdir, os.pardir):
+            return _Entry.from_path(path)
+        return self._listing(dirpath).get(name)
+
+    def update(self, path):
+        """ Refresh the cached entry for ``path``.
+
+        Call this after creating (or removing) ``path``.
+        """
+        dirpath, name = os.path.split(os.path.normpath(path))
+        dirpath = dirpath or os.curdir
+        if dirpath in self.listings:
+            listing = self._listing(dirpath)
+            entry = _Entry.from_path(path)
+            if entry is None:
+                listing.pop(name, None)
+            else:
+                listing[name] = entry
+
+    def exists(self, path):
+        entry = self._entry(path)
+        return entry is not None and entry.exists
+
+    def isdir(self, path):
+        entry = self._entry(path)
+        return entry is not None and entry.isdir
+
+    def isfile(self, path):
+        entry = self._entry(path)
+        return entry is not None and entry.isfile
+
+    def islink(self, path):
+        entry = self._entry(path)
+        return entry is not None and entry.islink
+
+    def readable(self, path):
+        entry = self._entry(path)
+        return entry is not None and entry.readable
+
+    def mode(self, path):
+        """ The permission bits of ``path``, if it is a file, else None.
+        """
+        entry = self._entry(path)
+        if entry is not None and entry.isfile:
+            return entry.mode
+
+
+def test_directory_cache(tmpdir):
+    from multiprocessing.pool import ThreadPool
+
+    tmpdir.join('album').ensure(dir=True)
+    tmpdir.join('album', 'photo.jpg').write('')
+    tmpdir.join('album', 'link.jpg').mksymlinkto('photo.jpg')
+    tmpdir.join('album', 'dangling.jpg').mksymlinkto('missing.jpg')
+    album = str(tmpdir.join('album'))
+
+    pool = ThreadPool(2)
+    try:
+        fs = DirectoryCache(pool)
+        fs.prefetch(album)
+        assert fs.isdir(album)
+        assert fs.exists(os.path.join(album, 'photo.jpg'))
+        assert fs.isfile(os.path.join(album, 'link.jpg'))
+        assert fs.islink(os.path.join(album, 'link.jpg'))
+        assert not fs.islink(os.path.join(album, 'photo.jpg'))
+        assert fs.islink(os.path.join(album, 'dangling.jpg'))
+        assert not fs.exists(os.path.join(album, 'dangling.jpg'))
+        assert not fs.exists(os.path.join(album, 'new.jpg'))
+        os.chmod(os.path.join(album, 'photo.jpg'), 0o640)
+        fs.update(os.path.join(album, 'photo.jpg'))
+        assert fs.mode(os.path.join(album, 'link.jpg')) is not None
+        assert fs.mode(os.path.join(album, 'photo.jpg')) == 0o640
+        assert fs.mode(album) is None
+
+        os.symlink('photo.jpg', os.path.join(album, 'new.jpg'))
+        fs.update(os.path.join(album, 'new.jpg'))
+        assert fs.islink(os.path.join(album, 'new.jpg'))
+        assert fs.exists(os.path.join(album, 'new.jpg'))
+    finally:
+        pool.close()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+""" The manifest of hidden albums and media.
+
+This is written by ``to-sigal`` to the root of the albums directory, and
+read by the ``hidden`` plugin, so that sigal can skip hidden albums and
+media without reading their metadata.
+
+It is a JSON object with ``albums`` and ``media`` keys, each a sorted
+list of paths relative to the albums directory.  Only the topmost
+hidden albums are listed; media within hidden albums are not listed.
+
+"""
+from __future__ import absolute_import
+
+import io
+import json
+from operator import attrgetter
+import os
+
+from six import text_type
+
+from .. import meta
+from ..traversal import walk
+
+HIDDEN_MANIFEST = '.hidden.json'
+
+
+def hidden_paths(album):
+    """ Find the hidden albums and media in the tree under ``album``.
+
+    Returns a pair of sorted lists of paths: ``(albums, media)``.
+    """
+    albums = []
+    media = []
+    is_hidden = attrgetter('is_hidden')
+    for item in walk(album, include=is_hidden, prune=is_hidden):
+        if isinstance(item, meta.AlbumItem):
+            albums.append(item.path or '.')
+        else:
+            media.append(item.path)
+    return sorted(albums), sorted(media)
+
+
+def write_hidden_manifest(album, albums_path, writer=None):
+    albums, media = hidden_paths(album)
+    _write(albums, media, albums_path, writer)
+
+
+def _write(albums, media, albums_path, writer=None):
+    data = json.dumps({'albums': albums, 'media': media},
+                      sort_keys=True, separators=(',', ':'))
+    data = (text_type(data) + u'\n').encode('utf-8')
+    path = os.path.join(albums_path, HIDDEN_MANIFEST)
+    if writer is not None:
+        writer.write(path, data)
+    else:
+        with io.open(path, 'wb') as fp:
+            fp.write(data)
+
+
+def update_hidden_manifest(album, albums_path, writer=None):
+    """ Update the manifest for the (rewritten) subtree under ``album``.
+
+    If there is no manifest, none is written.  (A manifest covering only
+    the subtree would hide too little.)
+    """
+    manifest = read_hidden_manifest(albums_path)
+    if manifest is None:
+        return
+    prefix = album.path + '/' if album.path else ''
+
+    def outside(path):
+        return path != album.path and not path.startswith(prefix)
+
+    albums, media = hidden_paths(album)
+    albums = sorted(set(albums).union(filter(outside, manifest[0])))
+    media = sorted(set(media).union(filter(outside, manifest[1])))
+    _write(albums, media, albums_path, writer)
+
+
+def read_hidden_manifest(albums_path):
+    """ Read the manifest in ``albums_path``.
+
+    Returns a pair of sets of paths, ``(albums, media)``, or ``None``
+    if there is no manifest.
+    """
+    path = os.path.join(albums_path, HIDDEN_MANIFEST)
+    try:
+        fp = io.open(path, encoding='utf-8')
+    except IOError:
+        return None
+    with fp:
+        data = json.load(fp)
+    return frozenset(data['albums']), frozenset(data['media'])
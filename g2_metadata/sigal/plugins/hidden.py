@@ -7,24 +7,120 @@ This omits generating any gallery products for albums or media which have::
 
 or similar set in their sigal metadata (.md) file.
 
+Hidden albums are found when the plugin is registered, and added to the
+``ignore_directories`` setting, so that sigal never builds albums or
+media within them.  They are read from the manifest written by
+``g2_metadata to-sigal`` (see ``g2_metadata.sigal.manifest``), or, if
+there is none, found by scanning the headers of the album ``index.md``
+files (without descending into hidden albums.)  Hidden media listed in
+the manifest are dropped without looking at their metadata.
+
 """
 from __future__ import absolute_import
 
-from collections import Counter, defaultdict, deque
+from collections import Counter, defaultdict
+import io
+import os
+import re
 
 from sigal import signals
 
+from ..manifest import read_hidden_manifest
 
-def is_hidden(obj):
-    hidden = '\n'.join(obj.meta.get('hidden', []))
+# A line of the metadata header, as understood by markdown.extensions.meta
+_META_RE = re.compile(r'^[ ]{0,3}(?P<key>[A-Za-z0-9_-]+):\s*(?P<value>.*)')
+_META_MORE_RE = re.compile(r'^[ ]{4,}(?P<value>.*)')
+
+# The paths of the hidden media listed in the manifest.  (These are
+# kept here, rather than in the settings, which sigal copies to each of
+# its worker processes.)
+_hidden_media = set()
+
+
+def _is_hidden(meta):
+    hidden = '\n'.join(meta.get('hidden', []))
     return hidden.strip().lower() in ('y', 'yes', 't', 'true')
 
 
-def walk_subalbums(album):
-    albums = deque(album.albums)
-    while albums:
-        albums.extend(albums[0].albums)
-        yield albums.popleft()
+def is_hidden(obj):
+    return _is_hidden(obj.meta)
+
+
+def read_meta(md_path):
+    """ Read the metadata header of a markdown file.
+
+    Only the header is read, not the rest of the file.  Returns a
+    ``dict`` like ``sigal``'s ``meta``, or ``None`` if there is no such
+    file.
+    """
+    try:
+        fp = io.open(md_path, encoding='utf-8-sig')
+    except IOError:
+        return None
+    meta = {}
+    key = None
+    with fp:
+        for line in fp:
+            if not line.strip():
+                break
+            m = _META_RE.match(line)
+            if m:
+                key = m.group('key').lower()
+                meta.setdefault(key, []).append(m.group('value').strip())
+                continue
+            m = _META_MORE_RE.match(line)
+            if m and key:
+                meta[key].append(m.group('value').strip())
+            else:
+                break
+    return meta
+
+
+def find_hidden_albums(source, md_name='index.md'):
+    """ Find the hidden albums under ``source``.
+
+    Returns the paths, relative to ``source``, of the hidden albums
+    which are not themselves within a hidden album.
+    """
+    hidden = []
+    for path, dirs, files in os.walk(source, followlinks=True):
+        if md_name in files:
+            meta = read_meta(os.path.join(path, md_name))
+            if meta and _is_hidden(meta):
+                hidden.append(os.path.relpath(path, source))
+                del dirs[:]     # prune
+    return hidden
+
+
+def ignore_patterns(album_path):
+    """ The ``ignore_directories`` patterns which match the album at
+    ``album_path`` and everything within it.
+    """
+    if album_path == '.':
+        return ['*']
+    pattern = re.sub(r'([[*?])', r'[\1]', album_path)
+    return [pattern, os.path.join(pattern, '*')]
+
+
+def subalbum_paths(gallery, album):
+    """ The paths of the albums within ``album`` which sigal has already
+    scanned.
+
+    These are found by following ``subdirs`` down from ``album``, so
+    only the albums within it are visited.
+    """
+    paths = []
+    parents = [album]
+    while parents:
+        parent = parents.pop()
+        for name in parent.subdirs:
+            if parent.path != '.':
+                name = os.path.join(parent.path, name)
+            subalbum = gallery.albums.get(name)
+            if subalbum is not None:
+                paths.append(name)
+                parents.append(subalbum)
+    return paths
 
 
 def after_album_initialized(album):
@@ -32,19 +128,23 @@ def after_album_initialized(album):
     gallery = album.gallery
 
     if is_hidden(album):
+        # This should have been ignored via ignore_directories, but just
+        # in case.
         logger.info("Ignoring hidden album: %s", album)
         # Since sigal scans directories depth-first, our subalbums have already
         # been scanned.  We need to remove sigal's memory of them.
-        for subalbum in walk_subalbums(album):
-            del gallery.albums[subalbum.path]
+        for path in subalbum_paths(gallery, album):
+            del gallery.albums[path]
         # Empty ourself out.  Sigal ignores empty albums.
         album.subdirs = []
         album.medias = []
     else:
         # Filter out hidden medias
+        root = album.path if album.path != '.' else ''
         visible_medias = []
         for media in album.medias:
-            if is_hidden(media):
+            path = os.path.join(root, media.src_filename)
+            if path in _hidden_media or is_hidden(media):
                 logger.info("Ignoring hidden media: %s", media)
             else:
                 visible_medias.append(media)
@@ -56,4 +156,38 @@ def after_album_initialized(album):
 
 
 def register(settings):
+    source = settings['source']
+    manifest = read_hidden_manifest(source)
+    _hidden_media.clear()
+    if manifest is not None:
+        hidden_albums, hidden_media = manifest
+        _hidden_media.update(hidden_media)
+    else:
+        hidden_albums = find_hidden_albums(source)
+
+    ignore_dirs = list(settings.get('ignore_directories') or [])
+    for album_path in sorted(hidden_albums):
+        ignore_dirs.extend(ignore_patterns(album_path))
+    settings['ignore_directories'] = ignore_dirs
+
     signals.album_initialized.connect(after_album_initialized)
+
+
+def test_subalbum_paths():
+    class Album(object):
+        def __init__(self, path, *subdirs):
+            self.path = path
+            self.subdirs = list(subdirs)
+
+    class Gallery(object):
+        albums = dict((album.path, album) for album in [
+            Album('a', 'b', 'gone'),
+            Album('a/b', 'c'),
+            Album('a/b/c'),
+            Album('ab'),
+            ])
+
+    gallery = Gallery()
+    assert sorted(subalbum_paths(gallery, gallery.albums['a'])) \
+        == ['a/b', 'a/b/c']
+    assert subalbum_paths(gallery, Album('.', 'ab')) == ['ab']
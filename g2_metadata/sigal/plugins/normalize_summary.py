@@ -1,52 +1,63 @@
 # -*- coding: utf-8 -*-
 """ Plugin to normalize {title, summary, description}
 
+The rules are in ``g2_metadata.sigal.summary``.  Items whose metadata
+were already normalized by ``to-sigal --normalize`` are skipped.
+
+The medias of each album are normalized in one pass, when the album is
+initialized.
+
 """
 from __future__ import absolute_import
 
-import os
-import re
-
 from sigal import signals
 
+from ..summary import Canonizer, is_normalized, normalize as normalized
 
-def _canonize(s):
-    return re.sub(r'[^\w]', '_', s.strip())
+
+def _get_canonizer(item):
+    try:
+        return item._normalize_canonizer
+    except AttributeError:
+        canonizer = item._normalize_canonizer = Canonizer(item.path)
+        return canonizer
 
 
 def normalize(item):
+    if is_normalized(item.meta):
+        return
     summary = item.meta.get('summary', [''])[0].strip()
-
-    fn = os.path.basename(item.path)
-    fnbase = os.path.splitext(fn)[0]
-    trivial_titles = _canonize(fn), _canonize(fnbase)
-
-    def is_trivial(s):
-        return not s or _canonize(s) in trivial_titles
-
-    if not is_trivial(summary):
-        if summary != item.title and is_trivial(item.title):
-            item.logger.info("Replacing title with summary for %s\n"
-                             "    was: %r\n"
-                             "    now: %r",
-                             item, item.title, summary)
-            item.title = summary
-
-        description = item.description
-        is_dup = description == item.title
-        if summary != description and (is_trivial(description) or is_dup):
+    title, description = normalized(
+        item.title, summary, item.description, _get_canonizer(item))
+
+    if title != item.title:
+        item.logger.info("Replacing title with summary for %s\n"
+                         "    was: %r\n"
+                         "    now: %r",
+                         item, item.title, title)
+        item.title = title
+
+    if description != item.description:
+        if description:
             item.logger.info("Replacing description with summary for %s\n"
                              "    was: %r\n"
                              "    now: %r",
-                             item, item.description, summary)
-            item.description = summary
-        elif is_dup:
+                             item, item.description, description)
+        else:
             item.logger.info("Clearing description with matches title for %s\n"
                              "    was: %r",
                              item, item.description)
-            item.description = ''
+        item.description = description
+
+
+def normalize_album(album):
+    """ Normalize an album and all of its medias.
+    """
+    normalize(album)
+    for media in album.medias:
+        normalize(media)
 
 
 def register(settings):
-    signals.album_initialized.connect(normalize)
-    signals.media_initialized.connect(normalize)
+    # Sigal initializes an album's medias before the album itself
+    signals.album_initialized.connect(normalize_album)
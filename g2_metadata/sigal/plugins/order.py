@@ -1,66 +1,44 @@
 # -*- coding: utf-8 -*-
 """ Plugin to sort albums and media the way they were ordered in gallery2.
 
+The sort order for an album is compiled from its ``order-by`` and
+``order-direction`` metadata once, and the keys for each item are
+computed once, then reused by each of the sorts which involve it.
+
+All keys compare natively (numbers, ``strxfrm`` strings, tuples of
+those.)  Descending numeric keys are negated.  Other descending keys
+are handled by sorting in several stable passes, from the least
+significant key to the most, each pass in its own direction.
+
 """
 from __future__ import absolute_import
 
-from functools import total_ordering
-from itertools import chain, repeat
+from itertools import chain, groupby, repeat
 import locale
 import logging
 import os
 import random
 
 from sigal import signals
-from six import text_type
+from six import PY2, text_type
 
 log = logging.getLogger(__name__)
 
 
-@total_ordering
-class backwards(object):
-    """A proxy which reverses the order of comparison operations.
-
-    """
-    def __init__(self, value):
-        self.value = value
-
-    def __repr__(self):
-        return "{0.__class__.__name__}({0.value!r})".format(self)
-
-    def __hash__(self):
-        return hash(self.value)
-
-    def __eq__(self, other):
-        if isinstance(other, backwards):
-            return self.value == other.value
-        else:
-            return self.value == other
-
-    def __lt__(self, other):
-        if isinstance(other, backwards):
-            return self.value > other.value  # Backwards!
-        else:
-            return self.value > other
-
+if PY2:
+    def _strxfrm(s):
+        return locale.strxfrm(text_type(s).encode('utf-8'))
+else:
+    _strxfrm = locale.strxfrm
 
-def test_backwards():
-    assert backwards(1) > backwards(2)
-    assert backwards('foo') == backwards('foo')
-    assert backwards(1) > 2
-    assert 1 > backwards(2)
-    assert 1 < 2
 
+def locale_key(s=u''):
+    """A key which sorts strings according to LC_COLLATE.
 
-@total_ordering
-class locale_str(text_type):
-    """A string which compares according to LC_COLLATE.
+    Comparing these is much faster than calling ``locale.strcoll`` for
+    each comparison.
     """
-    def __lt__(self, other):
-        return locale.strcoll(self, other) < 0
-
-    def __eq__(self, other):
-        return locale.strcoll(self, other) == 0
+    return _strxfrm(s)
 
 
 class _keybase(object):
@@ -77,11 +55,11 @@ def is_album(item):
 
 
 def by_description(item):
-    return locale_str(item.description)
+    return locale_key(item.description)
 
 
 def by_path_component(item):
-    return locale_str(os.path.basename(item.src_path))
+    return locale_key(os.path.basename(item.src_path))
 
 
 def by_random(item):
@@ -101,44 +79,85 @@ class by_meta(_keybase):
         return type_()
 
 
-class reversekey(_keybase):
+class negated(_keybase):
+    """Negate a numeric key, turning a descending key into an ascending one.
+    """
     def __call__(self, item):
         keyfunc, = self.args
-        return backwards(keyfunc(item))
+        return -keyfunc(item)
 
 
+# The following make ``(keyfunc, descending)`` pairs, given the
+# requested direction.
+
 class ascending(_keybase):
     def __call__(self, desc):
         keyfunc, = self.args
-        return keyfunc
+        return keyfunc, False
 
 
-class descending(_keybase):
+class reversable(_keybase):
     def __call__(self, desc):
-        keyfunc, = self.args
-        return reversekey(keyfunc)
+        keyfunc = self.args[0]
+        if desc and len(self.args) > 1:
+            negate = self.args[1]
+            return negate(keyfunc), False
+        return keyfunc, desc
 
 
-class reversable(_keybase):
-    def __call__(self, desc):
-        keyfunc, = self.args
-        return reversekey(keyfunc) if desc else keyfunc
+class sortorder(_keybase):
+    """A compiled sort order.
 
+    The arguments are ``(keyfuncs, descending)`` pairs, one for each sort
+    pass, most significant first.  The keys computed for each item are
+    cached.
+    """
+    def __init__(self, *args):
+        super(sortorder, self).__init__(*args)
+        self._cache = {}
+
+    def keys(self, item):
+        cached = self._cache.get(id(item))
+        if cached is None or cached[0] is not item:
+            keys = tuple(tuple(keyfunc(item) for keyfunc in keyfuncs)
+                         for keyfuncs, desc in self.args)
+            cached = self._cache[id(item)] = item, keys
+        return cached[1]
+
+    def sort(self, items, getitem=None):
+        """Sort ``items`` in place.
+
+        If given, ``getitem`` maps each of ``items`` to the album or media
+        whose keys it is to be sorted by.
+        """
+        if getitem is None:
+            keyed = [(self.keys(item), item) for item in items]
+        else:
+            keyed = [(self.keys(getitem(item)), item) for item in items]
+        for n in reversed(range(len(self.args))):
+            desc = self.args[n][1]
+            keyed.sort(key=lambda pair: pair[0][n], reverse=desc)
+        items[:] = [item for keys, item in keyed]
 
-class compoundkey(_keybase):
-    def __call__(self, item):
-        return tuple(keyfunc(item) for keyfunc in self.args)
+
+def test_sortorder():
+    first, second = lambda item: item[0], lambda item: item[1]
+    items = [(1, 'b'), (0, 'a'), (1, 'a'), (0, 'b')]
+    sortorder(((first,), False), ((second,), True)).sort(items)
+    assert items == [(0, 'b'), (0, 'a'), (1, 'b'), (1, 'a')]
+    sortorder(((first, second), True)).sort(items)
+    assert items == [(1, 'b'), (1, 'a'), (0, 'b'), (0, 'a')]
 
 
 ORDER_KEYS = {
     'orderWeight': ascending(by_meta('order-weight', int)),
-    'title': reversable(by_meta('title', locale_str)),
-    'summary': reversable(by_meta('summary', locale_str)),
-    'keywords': reversable(by_meta('keywords', locale_str)),
+    'title': reversable(by_meta('title', locale_key)),
+    'summary': reversable(by_meta('summary', locale_key)),
+    'keywords': reversable(by_meta('keywords', locale_key)),
     'originationTimestamp': reversable(by_meta('date')),
     'creationTimestamp': reversable(by_meta('created')),
     'modificationTimestamp': reversable(by_meta('updated')),
-    'viewCount': reversable(by_meta('view-count', int)),
+    'viewCount': reversable(by_meta('view-count', int), negated),
     # XXX: a little hokey, since item.description is HTML,
     # while in gallery it is bbcode.
     'description': reversable(by_description),
@@ -146,47 +165,67 @@ ORDER_KEYS = {
     'random': ascending(by_random),
 
     # "pre-orders":
-    'albumsFirst': descending(is_album),
-    'viewedFirst': descending(by_meta('view-count', int)),
+    'albumsFirst': ascending(negated(is_album)),
+    'viewedFirst': ascending(negated(by_meta('view-count', int))),
     # 'NewItems' not implemented,
     }
 
 
-def sortkey(album):
+def sortorder_for(album):
+    """Get the (cached) compiled sort order for the items in ``album``.
+
+    Returns ``None`` if the album does not specify a sort order.
+    """
+    try:
+        return album._order_sortorder
+    except AttributeError:
+        order = album._order_sortorder = _compile_sortorder(album)
+        return order
+
+
+def _compile_sortorder(album):
     meta = album.meta
     if 'order-by' not in meta:
         return None             # No sort specified
     orders = meta.get('order-by', ['orderWeight'])[0].split('|')
     directions = meta.get('order-direction', [''])[0].split('|')
     directions = chain(directions, repeat(directions[-1]))
-    keyfuncs = []
+    keys = []
     for order, direction in zip(orders, directions):
         order = order.strip()
         keymaker = ORDER_KEYS.get(order)
         if keymaker is None:
             log.warning("Unknown sortOrder key %r for %s", order, album)
-        keyfuncs.append(keymaker(desc=direction == 'desc'))
+            continue
+        keys.append(keymaker(desc=direction == 'desc'))
+
+    # Consecutive keys in the same direction are sorted in a single pass
+    passes = [(tuple(keyfunc for keyfunc, desc in group), desc)
+              for desc, group in groupby(keys, key=lambda key: key[1])]
+    return sortorder(*passes)
 
-    return compoundkey(*keyfuncs)
+
+def sort_items(album, items, getitem=None):
+    """Sort ``items`` in place, in the order specified by ``album``.
+    """
+    order = sortorder_for(album)
+    if order is not None:
+        order.sort(items, getitem)
 
 
 def resort_subdirs(album):
-    key = sortkey(album)
-    if key:
-        gallery = album.gallery
-        root_path = album.path if album.path != '.' else ''
+    gallery = album.gallery
+    root_path = album.path if album.path != '.' else ''
 
-        def subalbum(subdir):
-            return gallery.albums[os.path.join(root_path, subdir)]
+    def subalbum(subdir):
+        return gallery.albums[os.path.join(root_path, subdir)]
 
-        album.subdirs.sort(key=lambda subdir: key(subalbum(subdir)))
+    sort_items(album, album.subdirs, subalbum)
     add_items_attribute(album)
 
 
 def resort_medias(album):
-    key = sortkey(album)
-    if key:
-        album.medias.sort(key=key)
+    sort_items(album, album.medias)
     add_items_attribute(album)
 
 
@@ -199,9 +238,7 @@ def add_items_attribute(album):
 
     """
     album.items = album.albums + album.medias
-    key = sortkey(album)
-    if key:
-        album.items.sort(key=key)
+    sort_items(album, album.items)
 
 
 def register(settings):
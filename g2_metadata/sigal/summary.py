@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+""" Rules for normalizing {title, summary, description}
+
+These are applied either by the ``normalize_summary`` sigal plugin, at
+build time, or by ``to-sigal --normalize``, when the metadata is
+written.  In the latter case the ``.md`` header is marked with::
+
+    Normalized: yes
+
+and the plugin leaves the item alone.
+
+"""
+from __future__ import absolute_import
+
+import os
+import re
+
+NORMALIZED = 'normalized'
+
+_NON_WORD_RE = re.compile(r'[^\w]')
+
+
+class Canonizer(object):
+    """ Memoized canonical forms of the strings associated with an item.
+
+    ``path`` is the path whose basename (with or without extension) is
+    considered a trivial title.
+    """
+    def __init__(self, path):
+        self._canon = {}
+        fn = os.path.basename(path)
+        fnbase = os.path.splitext(fn)[0]
+        self.trivial_titles = self(fn), self(fnbase)
+
+    def __call__(self, s):
+        canon = self._canon.get(s)
+        if canon is None:
+            canon = self._canon[s] = _NON_WORD_RE.sub('_', s.strip())
+        return canon
+
+    def is_trivial(self, s):
+        return not s or self(s) in self.trivial_titles
+
+
+def normalize(title, summary, description, canonizer):
+    """ Apply the rules.
+
+    ``summary`` should be stripped.  Returns the normalized ``(title,
+    description)``.
+    """
+    is_trivial = canonizer.is_trivial
+    if not is_trivial(summary):
+        if summary != title and is_trivial(title):
+            title = summary
+
+        is_dup = description == title
+        if summary != description and (is_trivial(description) or is_dup):
+            description = summary
+        elif is_dup:
+            description = ''
+    return title, description
+
+
+def is_normalized(meta):
+    """ Whether ``meta`` (as parsed by sigal) is marked as normalized.
+    """
+    normalized = '\n'.join(meta.get(NORMALIZED, []))
+    return normalized.strip().lower() in ('y', 'yes', 't', 'true')
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+""" Find (and remove) orphaned files in the albums directory.
+
+Items deleted from gallery2 leave their ``.md`` files, and the symlinks
+created for linked items, behind.  The albums directory is indexed in a
+single scan, and the index is diffed against the items written.
+
+Only symlinks which could have been created for linked items (those to
+files, or to nothing, within the albums directory) are removed.  Other
+symlinks (to directories, or outside the albums directory) which do not
+belong to any item are only reported.
+
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+
+from .dircache import scan_directory
+
+log = logging.getLogger(__name__)
+
+
+def _is_file_link(path, entry, albums_roots):
+    # Whether the symlink at ``path`` (with directory cache ``entry``)
+    # is to a file (or to nothing) within the albums directory, one of
+    # whose absolute paths are ``albums_roots``.  (Only the link itself
+    # is read; its target is not resolved any further.)
+    if entry.isdir:
+        return False
+    target = os.path.join(os.path.dirname(path), os.readlink(path))
+    target = os.path.normpath(target)
+    return any(target.startswith(root) for root in albums_roots)
+
+
+def index_albums(albums_path, fs=None, subdir=''):
+    """ Find the ``.md`` files and symlinks under ``albums_path`` (or
+    under its ``subdir``.)
+
+    Returns a triple of sets of paths, relative to ``albums_path``:
+    ``(md_files, symlinks, other_symlinks)``.  ``symlinks`` are those to
+    files (or to nothing) within ``albums_path``; ``other_symlinks`` are
+    the rest.  Symlinked directories are not followed.
+
+    If ``fs`` (a ``DirectoryCache``) is given, the directory listings
+    are stored in it.
+    """
+    albums_roots = set(os.path.join(root, '')
+                       for root in (os.path.abspath(albums_path),
+                                    os.path.realpath(albums_path)))
+    md_files = set()
+    symlinks = set()
+    other_symlinks = set()
+    dirs = [subdir or os.curdir]
+    while dirs:
+        reldir = dirs.pop()
+        dirpath = os.path.normpath(os.path.join(albums_path, reldir))
+        abs_dirpath = os.path.abspath(dirpath)
+        listing = scan_directory(dirpath)
+        if fs is not None:
+            fs.listings.setdefault(dirpath, listing)
+        for name, entry in listing.items():
+            path = os.path.normpath(os.path.join(reldir, name))
+            if entry.islink:
+                if _is_file_link(os.path.join(abs_dirpath, name), entry,
+                                 albums_roots):
+                    symlinks.add(path)
+                else:
+                    other_symlinks.add(path)
+            elif entry.isdir:
+                dirs.append(path)
+            elif name.endswith('.md'):
+                md_files.add(path)
+    return md_files, symlinks, other_symlinks
+
+
+def find_orphans(index, md_paths, targets):
+    """ Find the files in ``index`` which do not belong to any item.
+
+    ``md_paths`` are the metadata files written, and ``targets`` the
+    paths of all the items (relative to the albums directory.)
+    """
+    md_files, symlinks, other_symlinks = index
+    md_paths = set(os.path.normpath(path) for path in md_paths)
+    targets = set(os.path.normpath(path) for path in targets if path)
+    return sorted((md_files - md_paths) | (symlinks - targets))
+
+
+def find_foreign_symlinks(index, targets):
+    """ Find the symlinks in ``index`` which do not belong to any item,
+    but which are not to files within the albums directory (so were not
+    created by ``to-sigal``.)
+    """
+    md_files, symlinks, other_symlinks = index
+    targets = set(os.path.normpath(path) for path in targets if path)
+    return sorted(other_symlinks - targets)
+
+
+def report_foreign_symlinks(foreign_symlinks):
+    for path in foreign_symlinks:
+        log.warning("%s: symlink does not belong to any item (not removed)",
+                    path)
+
+
+def remove_orphans(albums_path, orphans, dry_run=False, fs=None):
+    for orphan in orphans:
+        if dry_run:
+            log.warning("%s: orphaned", orphan)
+            continue
+        log.info("%s: removing orphan", orphan)
+        path = os.path.join(albums_path, orphan)
+        os.unlink(path)
+        if fs is not None:
+            fs.update(path)
+
+
+def test_find_orphans(tmpdir):
+    tmpdir.join('outside.jpg').write('')
+    albums = tmpdir.join('albums')
+    albums.join('a1').ensure(dir=True)
+    for name in ['index.md', 'top.jpg', 'top.md', 'gone.md',
+                 'a1/index.md', 'a1/p1.jpg', 'a1/p1.md']:
+        albums.join(name).write('')
+    albums.join('a1', 'lnk.jpg').mksymlinkto('p1.jpg')
+    albums.join('a1', 'old.jpg').mksymlinkto('p1.jpg')
+    albums.join('a1', 'dangling.jpg').mksymlinkto('gone.jpg')
+    albums.join('linked').mksymlinkto('a1')
+    albums.join('mine').mksymlinkto('a1')
+    albums.join('outside.jpg').mksymlinkto('../outside.jpg')
+    albums.join('absolute.jpg').mksymlinkto(str(albums.join('top.jpg')))
+
+    index = index_albums(str(albums))
+    assert index == ({'index.md', 'top.md', 'gone.md', 'a1/index.md',
+                      'a1/p1.md'},
+                     {'a1/lnk.jpg', 'a1/old.jpg', 'a1/dangling.jpg',
+                      'absolute.jpg'},
+                     {'linked', 'mine', 'outside.jpg'})
+    md_paths = ['index.md', 'top.md', 'a1/index.md', 'a1/p1.md']
+    targets = ['', 'top.jpg', 'a1', 'a1/p1.jpg', 'a1/lnk.jpg', 'linked']
+    orphans = find_orphans(index, md_paths, targets)
+    assert orphans == ['a1/dangling.jpg', 'a1/old.jpg', 'absolute.jpg',
+                       'gone.md']
+    assert find_foreign_symlinks(index, targets) == ['mine', 'outside.jpg']
+
+    remove_orphans(str(albums), orphans)
+    assert not albums.join('gone.md').check()
+    assert not albums.join('a1', 'old.jpg').check(link=1)
+    assert albums.join('a1', 'lnk.jpg').check(link=1)
+    assert albums.join('mine').check(link=1)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+""" Atomic, write-behind file writes.
+
+Each file is written to a temporary file in the same directory, which
+is then renamed into place, so that readers (e.g. a concurrently running
+sigal build) never see a partially written file.
+
+Writes may be handed off to a thread pool.  The number of writes
+pending is bounded, so that rendering does not run arbitrarily far
+ahead of the disk.  The files themselves are not ``fsync``\\ed; each
+directory written to is ``fsync``\\ed once, when the writer is flushed
+or closed.
+
+"""
+from __future__ import absolute_import
+
+from multiprocessing.pool import ThreadPool
+import os
+import tempfile
+import threading
+
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def _fsync_directory(dirpath):
+    fd = os.open(dirpath, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AtomicWriter(object):
+    """ Write files atomically.
+
+    If ``jobs`` is given, files are written in that many threads, with
+    at most ``max_pending`` writes queued.  Errors from those writes are
+    raised by ``close``.
+
+    If ``fsync`` is false, the directories are not ``fsync``\\ed either.
+    """
+    def __init__(self, jobs=None, max_pending=None, fsync=True):
+        self.fsync = fsync
+        self.mode = 0o666 & ~_umask()
+        self.directories = set()
+        self.errors = []
+        self.lock = threading.Lock()
+        if jobs and jobs > 1:
+            self.pool = ThreadPool(jobs)
+            self.max_pending = max_pending or 4 * jobs
+            self.pending = threading.BoundedSemaphore(self.max_pending)
+        else:
+            self.pool = None
+
+    def write(self, path, data, mode=None):
+        """ Write ``data`` (bytes) to ``path``.
+
+        The file is given permissions ``mode`` (by default, those a
+        newly created file would get.)
+        """
+        if mode is None:
+            mode = self.mode
+        if self.pool is None:
+            self._write(path, data, mode)
+        else:
+            self.pending.acquire()
+            self.pool.apply_async(self._write_behind, (path, data, mode))
+
+    def _write_behind(self, path, data, mode):
+        try:
+            self._write(path, data, mode)
+        except Exception as exc:
+            with self.lock:
+                self.errors.append(exc)
+        finally:
+            self.pending.release()
+
+    def _write(self, path, data, mode):
+        dirpath, name = os.path.split(path)
+        fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % name,
+                                        suffix='.tmp', dir=dirpath or None)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.chmod(tmp_path, mode)
+            os.rename(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        with self.lock:
+            self.directories.add(dirpath or os.curdir)
+
+    def flush(self):
+        """ Wait for all pending writes, and sync their directories.
+        """
+        if self.pool is not None:
+            # Wait until no writes are pending
+            for _ in range(self.max_pending):
+                self.pending.acquire()
+            for _ in range(self.max_pending):
+                self.pending.release()
+        self._sync()
+
+    def close(self):
+        """ Flush, and shut down the thread pool.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self._sync()
+
+    def _sync(self):
+        if self.errors:
+            raise self.errors[0]
+        if self.fsync:
+            for dirpath in sorted(self.directories):
+                _fsync_directory(dirpath)
+        self.directories.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        elif self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+
+def test_atomic_writer(tmpdir):
+    with AtomicWriter(jobs=2, max_pending=1) as writer:
+        for n in range(10):
+            writer.write(str(tmpdir.join('%d.md' % n)),
+                         ('data %d' % n).encode('ascii'))
+    assert sorted(p.basename for p in tmpdir.listdir()) \
+        == sorted('%d.md' % n for n in range(10))
+    assert tmpdir.join('3.md').read() == 'data 3'
+
+    with AtomicWriter() as writer:
+        writer.write(str(tmpdir.join('3.md')), b'new', mode=0o600)
+    assert tmpdir.join('3.md').read() == 'new'
+    assert tmpdir.join('3.md').stat().mode & 0o777 == 0o600
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+""" SQLite export and import of the normalized layout.
+
+The records of the normalized layout (see ``g2_metadata.normalized``)
+are written to a local SQLite database, with the tables indexed so that
+items can be looked up by id, path or parent without reading anything
+else.  Records are stored JSON-encoded (see ``g2_metadata.jsonl``.)
+
+The reader is lazy: only the header tables (users, groups, access maps
+and plugin parameters) are read up front.  Items, and their subitems,
+owners and comments, are read as they are reached.
+
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import sqlite3
+
+from . import jsonl
+from . import normalized
+
+SCHEMA = '''
+CREATE TABLE properties (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL);
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY,
+    record TEXT NOT NULL);
+CREATE TABLE user_groups (
+    id INTEGER PRIMARY KEY,
+    record TEXT NOT NULL);
+CREATE TABLE access_maps (
+    accessListId INTEGER NOT NULL,
+    userOrGroupId INTEGER NOT NULL,
+    permission INTEGER NOT NULL);
+CREATE TABLE plugin_parameters (
+    pluginType TEXT NOT NULL,
+    pluginId TEXT NOT NULL,
+    parameterName TEXT NOT NULL,
+    parameterValue TEXT);
+CREATE TABLE items (
+    id INTEGER PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    parentId INTEGER NOT NULL,
+    linkId INTEGER,
+    path TEXT NOT NULL,
+    class TEXT NOT NULL,
+    record TEXT NOT NULL);
+CREATE TABLE comments (
+    id INTEGER PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    parentId INTEGER NOT NULL,
+    record TEXT NOT NULL);
+'''
+
+INDEXES = '''
+CREATE INDEX access_maps_accessListId ON access_maps (accessListId);
+CREATE UNIQUE INDEX items_path ON items (path);
+CREATE INDEX items_parentId ON items (parentId, seq);
+CREATE INDEX items_linkId ON items (linkId);
+CREATE INDEX comments_parentId ON comments (parentId, seq);
+'''
+
+BATCH_SIZE = 1000
+
+
+def _json(value):
+    return json.dumps(jsonl.encode(value), separators=(',', ':'))
+
+
+def _batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _write_header(db, header):
+    properties = [(name, _json(header[name]))
+                  for name in ('layout', 'root', 'timestamps')]
+    db.executemany("INSERT INTO properties VALUES (?, ?)", properties)
+    db.executemany("INSERT INTO users VALUES (?, ?)",
+                   [(user['id'], _json(user)) for user in header['users']])
+    db.executemany("INSERT INTO user_groups VALUES (?, ?)",
+                   [(group['id'], _json(group))
+                    for group in header['groups']])
+    db.executemany(
+        "INSERT INTO access_maps VALUES (?, ?, ?)",
+        [(access_list_id, entry['userOrGroupId'], entry['permission'])
+         for access_list_id, entries in header['access_lists'].items()
+         for entry in entries])
+    db.executemany(
+        "INSERT INTO plugin_parameters VALUES (?, ?, ?, ?)",
+        [(ptype, pid, name, _json(value))
+         for ptype, by_id in (header['plugin_parameters'] or {}).items()
+         for pid, params in by_id.items()
+         for name, value in params.items()])
+
+
+def _write_records(db, records):
+    for batch in _batches(enumerate(records)):
+        items = []
+        comments = []
+        for seq, record in batch:
+            if record['class'] == 'Comment':
+                comments.append((record['id'], seq, record['parentId'],
+                                 _json(record)))
+            else:
+                items.append((record['id'], seq, record['parentId'],
+                              record.get('linkId'), record['path'],
+                              record['class'], _json(record)))
+        db.executemany("INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       items)
+        db.executemany("INSERT INTO comments VALUES (?, ?, ?, ?)", comments)
+
+
+def dump(records, path):
+    """ Write normalized ``records`` (header first) to a new SQLite
+    database at ``path``.
+
+    The database is built in a temporary file which is then moved into
+    place, so that readers never see a partially written database.
+    """
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    try:
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        db.executescript(SCHEMA)
+        records = iter(records)
+        _write_header(db, next(records))
+        _write_records(db, records)
+        db.executescript(INDEXES)
+        db.commit()
+    finally:
+        db.close()
+    os.rename(tmp_path, path)
+
+
+class SqliteRecordStore(object):
+    """ A record store which reads records from an SQLite export on demand.
+
+    This provides the same interface as
+    ``g2_metadata.normalized.RecordStore``.  It is pickled as a
+    ``RecordStore``, with all of the records read.
+
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.header = header = dict(
+            (name, json.loads(value))
+            for name, value in self.db.execute(
+                "SELECT name, value FROM properties"))
+        self.timestamps = frozenset(header.get('timestamps', ()))
+        # Records of the subitems (or links) last looked up, which have
+        # been read, but not yet asked for
+        self._prefetched = {}
+
+        header['users'] = self._records(
+            "SELECT record FROM users ORDER BY id")
+        header['groups'] = self._records(
+            "SELECT record FROM user_groups ORDER BY id")
+
+        access_lists = header['access_lists'] = {}
+        for access_list_id, user_or_group_id, permission in self.db.execute(
+                "SELECT accessListId, userOrGroupId, permission"
+                " FROM access_maps ORDER BY rowid"):
+            access_lists.setdefault(access_list_id, []).append({
+                'userOrGroupId': user_or_group_id,
+                'permission': permission,
+                })
+
+        plugin_parameters = header['plugin_parameters'] = {}
+        for ptype, pid, name, value in self.db.execute(
+                "SELECT pluginType, pluginId, parameterName, parameterValue"
+                " FROM plugin_parameters"):
+            by_id = plugin_parameters.setdefault(ptype, {})
+            by_id.setdefault(pid, {})[name] = jsonl.decode(json.loads(value))
+        if not plugin_parameters:
+            # as returned by models.get_global_plugin_parameters
+            header['plugin_parameters'] = None
+
+    def __reduce__(self):
+        # The database connection can not be pickled
+        store = self.to_record_store()
+        return normalized.RecordStore, (store.header,), store.__dict__
+
+    def to_record_store(self):
+        """ Read all the records into a ``normalized.RecordStore``.
+        """
+        store = normalized.RecordStore(self.header)
+        for record in self._records("SELECT record FROM items"
+                                    " ORDER BY seq"):
+            store.add(record)
+        for record in self._records("SELECT record FROM comments"
+                                    " ORDER BY seq"):
+            store.add(record)
+        return store
+
+    def close(self):
+        self._prefetched.clear()
+        self.db.close()
+
+    def _decode(self, record):
+        return jsonl.decode_record(json.loads(record), self.timestamps)
+
+    def _records(self, sql, *params):
+        return [self._decode(record)
+                for record, in self.db.execute(sql, params)]
+
+    def _prefetch(self, sql, *params):
+        # Those prefetched before which were not asked for have already
+        # been built
+        self._prefetched.clear()
+        item_ids = []
+        for item_id, record in self.db.execute(sql, params):
+            self._prefetched[item_id] = record
+            item_ids.append(item_id)
+        return item_ids
+
+    def get_item(self, item_id):
+        record = self._prefetched.pop(item_id, None)
+        if record is None:
+            row = self.db.execute("SELECT record FROM items WHERE id = ?",
+                                  (item_id,)).fetchone()
+            if row is None:
+                return None
+            record, = row
+        return self._decode(record)
+
+    def get_item_id_by_path(self, path):
+        row = self.db.execute("SELECT id FROM items WHERE path = ?",
+                              (path,)).fetchone()
+        if row is not None:
+            return row[0]
+
+    def get_item_by_path(self, path):
+        row = self.db.execute("SELECT record FROM items WHERE path = ?",
+                              (path,)).fetchone()
+        if row is not None:
+            return self._decode(row[0])
+
+    def get_children(self, item_id):
+        return self._prefetch(
+            "SELECT id, record FROM items WHERE parentId = ? ORDER BY seq",
+            item_id)
+
+    def get_comments(self, item_id):
+        return self._records(
+            "SELECT record FROM comments WHERE parentId = ? ORDER BY seq",
+            item_id)
+
+    def get_linked_from(self, item_id):
+        return self._prefetch(
+            "SELECT id, record FROM items WHERE linkId = ? ORDER BY seq",
+            item_id)
+
+
+def load(path):
+    return normalized.NormalizedMetadata(SqliteRecordStore(path))
+
+
+def test_pickle_roundtrip(tmpdir):
+    import pickle
+
+    header = {
+        'layout': normalized.LAYOUT,
+        'root': 1,
+        'timestamps': ['date'],
+        'users': [{'class': 'User', 'id': 9, 'userName': 'u',
+                   'groupIds': []}],
+        'groups': [],
+        'access_lists': {},
+        'plugin_parameters': None,
+        }
+
+    def item(cls, item_id, parent_id, path):
+        return {'class': cls, 'id': item_id, 'parentId': parent_id,
+                'path': path, 'ownerId': 9, 'linkId': None}
+
+    records = [
+        header,
+        item('AlbumItem', 1, 0, ''),
+        item('AlbumItem', 2, 1, 'a'),
+        item('PhotoItem', 3, 2, 'a/p.jpg'),
+        item('PhotoItem', 4, 1, 'q.jpg'),
+        {'class': 'Comment', 'id': 5, 'parentId': 3, 'text': 'c'},
+        ]
+    path = str(tmpdir.join('m.sqlite'))
+    dump(records, path)
+    g2data = load(path)
+    assert g2data.item_by_path('a').subitems[0].path == 'a/p.jpg'
+    pickled = pickle.dumps(g2data, pickle.HIGHEST_PROTOCOL)
+    g2data.records.close()
+
+    g2data = pickle.loads(pickled)
+    assert isinstance(g2data.records, normalized.RecordStore)
+    root = g2data['album']
+    assert [subitem.path for subitem in root.subitems] == ['a', 'q.jpg']
+    photo, = root.subitems[0].subitems
+    assert photo.owner.userName == 'u'
+    assert [comment.text for comment in photo.comments] == ['c']
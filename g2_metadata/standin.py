@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+""" A stand-in for the gallery2 database.
+
+This creates the gallery2 tables (as described by ``g2_metadata.models``)
+in a local SQLite database, and fills them from a metadata snapshot, so
+that ``dump`` can be run (and profiled) without a gallery2 MySQL server.
+
+Only what the snapshot records is written.  In particular, album
+hilights are written as a single derivative (sourced directly from the
+hilight item), and entity types which the snapshot does not contain
+(e.g. derivatives other than hilights) are omitted.
+
+"""
+from __future__ import absolute_import
+
+from collections import defaultdict
+from datetime import datetime
+
+import phpserialize
+import sqlalchemy as sa
+from six import string_types
+
+from . import meta, models
+from .models.access import t_UserGroupMap
+from .models.derivative import t_DerivativePrefsMap
+from .models.item import t_ItemHiddenMap
+from .models.plugin import PluginParameterMap
+from .models.types import Timestamp
+from .normalized import load_records
+from .util import walk_items
+
+
+def create_engine(path=None):
+    """ Create an SQLite database at ``path`` (or in memory), containing
+    the (empty) gallery2 tables.
+    """
+    engine = sa.create_engine('sqlite:///%s' % path if path else 'sqlite://')
+    models.metadata.create_all(engine)
+    return engine
+
+
+class BatchInserter(object):
+    """ Accumulate rows, and insert them in batches.
+    """
+    def __init__(self, conn, batch_size=1000):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.rows = defaultdict(list)
+
+    def add(self, table, **row):
+        rows = self.rows[table]
+        rows.append(row)
+        if len(rows) >= self.batch_size:
+            self.flush(table)
+
+    def flush(self, table=None):
+        tables = [table] if table is not None else list(self.rows)
+        for table in tables:
+            rows = self.rows.pop(table, None)
+            if rows:
+                self.conn.execute(table.insert(), rows)
+
+
+def _column_value(obj, column):
+    if column.key.endswith('_itemId'):
+        # e.g. ItemAttributesMap._ItemAttributesMap_itemId
+        return obj.id
+    value = getattr(obj, column.key, None)
+    if value is None and not column.nullable:
+        if isinstance(column.type, Timestamp):
+            return -1
+        elif column.server_default is not None:
+            return column.server_default.arg.text.strip("'")
+    return value
+
+
+def _php_value(value):
+    # Undo models.plugin._maybe_php_deserialize
+    if value is None:
+        return 'a:0:{}'
+    elif isinstance(value, string_types):
+        return value
+    return phpserialize.dumps(value)
+
+
+class _Hilight(object):
+    """ The derivative from which gallery2 finds an album's hilight.
+    """
+    entityType = 'GalleryDerivativeImage'
+    derivativeType = 1          # thumbnail
+    mimeType = 'image/jpeg'
+    serialNumber = 1
+
+    def __init__(self, derivative_id, album, hilight):
+        self.id = derivative_id
+        self.parentId = album.id
+        self.derivativeSourceId = hilight.id
+
+
+class _Populator(object):
+    def __init__(self, conn):
+        self.rows = BatchInserter(conn)
+        self.access_list_ids = set()
+        self.next_id = None
+
+    def entity(self, obj, model):
+        for table in sa.inspect(model).tables:
+            if table is t_ItemHiddenMap and not obj.is_hidden:
+                continue
+            self.rows.add(table, **dict(
+                (column.key, _column_value(obj, column))
+                for column in table.c))
+
+    def access_list(self, obj):
+        access_list = obj.accessList
+        if access_list:
+            access_list_id = access_list[0].accessListId
+            self.rows.add(models.AccessSubscriberMap.__table__,
+                          itemId=obj.id, accessListId=access_list_id)
+            if access_list_id not in self.access_list_ids:
+                self.access_list_ids.add(access_list_id)
+                for entry in access_list:
+                    self.rows.add(models.AccessMap.__table__,
+                                  accessListId=access_list_id,
+                                  userOrGroupId=entry.userOrGroupId,
+                                  permission=entry.permission)
+
+    def plugin_parameters(self, item_id, plugin_parameters):
+        for ptype, by_id in (plugin_parameters or {}).items():
+            for pid, params in by_id.items():
+                for name, value in params.items():
+                    self.rows.add(PluginParameterMap.__table__,
+                                  pluginType=ptype, pluginId=pid,
+                                  itemId=item_id, parameterName=name,
+                                  parameterValue=_php_value(value))
+
+    def hilight(self, album, hilight):
+        derivative = _Hilight(self.next_id, album, hilight)
+        self.next_id += 1
+        self.entity(derivative, models.DerivativeImage)
+
+    def derivative_prefs(self, album):
+        for dtype, operations in (album.derivative_prefs or {}).items():
+            for order, ops in enumerate(operations):
+                self.rows.add(t_DerivativePrefsMap,
+                              itemId=album.id, order=order,
+                              derivativeType=dtype,
+                              derivativeOperations=ops)
+
+    def item(self, item):
+        model = getattr(models, type(item).__name__)
+        self.entity(item, model)
+        self.access_list(item)
+        for comment in item.comments:
+            self.entity(comment, models.Comment)
+        if isinstance(item, meta.AlbumItem):
+            self.plugin_parameters(item.id, item.plugin_parameters)
+            self.derivative_prefs(item)
+            hilight = getattr(item, 'hilight', None)
+            if hilight is not None:
+                self.hilight(item, hilight)
+
+    def populate(self, metadata):
+        for group in metadata['groups']:
+            self.entity(group, models.Group)
+            self.access_list(group)
+        for user in metadata['users']:
+            self.entity(user, models.User)
+            self.access_list(user)
+            self.plugin_parameters(user.id, user.plugin_parameters)
+            for group in user.groups:
+                self.rows.add(t_UserGroupMap,
+                              userId=user.id, groupId=group.id)
+        self.plugin_parameters(0, metadata['plugin_parameters'])
+
+        items = list(walk_items(metadata['album']))
+        # Ids for the hilight derivatives
+        self.next_id = 1 + max(
+            [item.id for item in items]
+            + [comment.id for item in items for comment in item.comments]
+            + [entity.id for entity in metadata['users']]
+            + [entity.id for entity in metadata['groups']])
+        for item in items:
+            self.item(item)
+        self.rows.flush()
+        return len(items)
+
+
+def populate(engine, metadata):
+    """ Fill the (empty) gallery2 tables in ``engine`` from a metadata
+    snapshot (as loaded by ``g2_metadata.loader``.)
+
+    Returns the number of items written.
+    """
+    with engine.begin() as conn:
+        return _Populator(conn).populate(metadata)
+
+
+def sample_gallery(engine):
+    """ Fill the (empty) gallery2 tables in ``engine`` with a small
+    gallery, for tests.
+
+    The root album (1) contains albums ``a`` (2) and ``b`` (5), and
+    ``top.jpg`` (6); ``a`` contains ``p.jpg`` (3) and ``q.jpg`` (4).
+
+    Returns the paths of the items.
+    """
+
+    header = {
+        'root': 1,
+        'users': [{'class': 'User', 'id': 100, 'userName': 'u',
+                   'entityType': 'GalleryUser', 'groupIds': [],
+                   'plugin_parameters': None,
+                   'modificationTimestamp': datetime(2001, 1, 2)}],
+        'groups': [],
+        'access_lists': {},
+        'plugin_parameters': {'module': {'core': {
+            'default.orderBy': 'orderWeight',
+            'default.orderDirection': 'asc'}}},
+        }
+
+    def item(cls, item_id, parent_id, path, order_weight):
+        parent_sequence = {0: '', 1: '1/', 2: '1/2/', 5: '1/5/'}[parent_id]
+        return {
+            'class': cls, 'entityType': 'Gallery' + cls, 'id': item_id,
+            'parentId': parent_id, 'parentSequence': parent_sequence,
+            'path': path, 'pathComponent': path.rsplit('/', 1)[-1] or None,
+            'canContainChildren': int(cls == 'AlbumItem'),
+            'title': path or 'Gallery', 'ownerId': 100,
+            'orderWeight': order_weight, 'is_hidden': False,
+            'plugin_parameters': None, 'derivative_prefs': None,
+            'hilightId': 4 if cls == 'AlbumItem' else None,
+            'creationTimestamp': datetime(2001, 1, 1),
+            'modificationTimestamp': datetime(2001, 1, 1),
+            'originationTimestamp': datetime(2001, 1, 1),
+            }
+
+    records = [
+        item('AlbumItem', 1, 0, '', 0),
+        item('AlbumItem', 2, 1, 'a', 1),
+        item('PhotoItem', 3, 2, 'a/p.jpg', 1),
+        item('PhotoItem', 4, 2, 'a/q.jpg', 2),
+        item('AlbumItem', 5, 1, 'b', 2),
+        item('PhotoItem', 6, 1, 'top.jpg', 3),
+        ]
+    populate(engine, load_records(header, iter(records)))
+    return [record['path'] for record in records]
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+""" Traversal of the item tree.
+
+These work on both the ORM-mapped items (``g2_metadata.models``) and
+the loaded ones (``g2_metadata.meta``.)  Items are generated lazily, so
+a walk may be abandoned early.
+
+"""
+from __future__ import absolute_import
+
+BFS = 'bfs'
+DFS = 'dfs'
+
+
+def _matcher(include):
+    if include is None:
+        return lambda item: True
+    elif isinstance(include, (type, tuple)):
+        return lambda item: isinstance(item, include)
+    return include
+
+
+def walk(root, order=BFS, include=None, prune=None, max_depth=None,
+         prefetch=None, leave=None):
+    """ Walk the items in the tree under (and including) ``root``.
+
+    ``order`` is ``BFS`` (breadth first) or ``DFS`` (depth first,
+    pre-order.)
+
+    Only items matching ``include`` (a predicate, or a class or tuple of
+    classes) are generated, though the walk descends through the others.
+    The subitems of items matching ``prune`` (a predicate) are not
+    visited, nor are items deeper than ``max_depth`` (``root`` is at
+    depth 0.)
+
+    ``prefetch``, if given, is called with lists of items whose
+    subitems are about to be visited (e.g. to load them in a batch.)  In
+    breadth first order, it is called once per level of the tree.  In
+    depth first order, it is called once per album, with those of its
+    subitems which will be descended into (and first with ``[root]``.)
+
+    ``leave``, if given, is called with each item whose subitems have
+    been visited, after the last of them (before the walk moves on.)  It
+    may only be given for depth first walks.
+    """
+    include = _matcher(include)
+
+    def expand(item, depth):
+        return ((max_depth is None or depth < max_depth)
+                and getattr(item, 'canContainChildren', True)
+                and not (prune is not None and prune(item)))
+
+    if order == BFS:
+        if leave is not None:
+            raise ValueError("leave requires a depth first walk")
+        return _walk_bfs(root, include, expand, prefetch)
+    elif order == DFS:
+        return _walk_dfs(root, include, expand, prefetch, leave)
+    raise ValueError("unknown order %r" % order)
+
+
+def _walk_bfs(root, include, expand, prefetch):
+    level = [root]
+    depth = 0
+    while level:
+        parents = [item for item in level if expand(item, depth)]
+        if prefetch is not None and parents:
+            prefetch(parents)
+        for item in level:
+            if include(item):
+                yield item
+        level = [subitem for item in parents for subitem in item.subitems]
+        depth += 1
+
+
+def _walk_dfs(root, include, expand, prefetch, leave):
+    if prefetch is not None and expand(root, 0):
+        prefetch([root])
+    stack = [(0, None, iter([root]))]
+    while stack:
+        depth, parent, items = stack[-1]
+        for item in items:
+            if include(item):
+                yield item
+            if expand(item, depth):
+                subitems = item.subitems
+                if prefetch is not None:
+                    parents = [subitem for subitem in subitems
+                               if expand(subitem, depth + 1)]
+                    if parents:
+                        prefetch(parents)
+                stack.append((depth + 1, item, iter(subitems)))
+                break
+        else:
+            stack.pop()
+            if leave is not None and parent is not None:
+                leave(parent)
+
+
+def test_walk():
+    class Item(object):
+        def __init__(self, name, *subitems):
+            self.name = name
+            self.subitems = list(subitems)
+            self.canContainChildren = bool(subitems)
+
+    tree = Item('root',
+                Item('a', Item('a1'), Item('a2', Item('a2x'))),
+                Item('b', Item('b1')),
+                Item('c'))
+
+    def names(**kw):
+        return [item.name for item in walk(tree, **kw)]
+
+    assert names() == ['root', 'a', 'b', 'c', 'a1', 'a2', 'b1', 'a2x']
+    assert names(order=DFS) == ['root', 'a', 'a1', 'a2', 'a2x', 'b', 'b1',
+                                'c']
+    assert names(order=DFS, prune=lambda item: item.name == 'a') \
+        == ['root', 'a', 'b', 'b1', 'c']
+    assert names(max_depth=1) == ['root', 'a', 'b', 'c']
+    assert names(include=lambda item: item.canContainChildren) \
+        == ['root', 'a', 'b', 'a2']
+
+    prefetched = []
+    list(walk(tree, prefetch=prefetched.append))
+    assert [[item.name for item in items] for items in prefetched] \
+        == [['root'], ['a', 'b'], ['a2']]
+
+    events = []
+    for item in walk(tree, order=DFS,
+                     leave=lambda item: events.append('/' + item.name)):
+        events.append(item.name)
+    assert events == ['root', 'a', 'a1', 'a2', 'a2x', '/a2', '/a',
+                      'b', 'b1', '/b', 'c', '/root']
+
+    prefetched = []
+    list(walk(tree, order=DFS, prefetch=prefetched.append))
+    assert [[item.name for item in items] for items in prefetched] \
+        == [['root'], ['a', 'b'], ['a2']]
@@ -4,8 +4,14 @@
 from __future__ import absolute_import
 
 from collections import deque
+from contextlib import contextmanager
+import os
+import tempfile
+
 from six import binary_type
 
+from . import meta
+
 
 def text_(s, encoding='latin-1', errors='strict'):
     """ If ``s`` is an instance of ``binary_type``, return
@@ -15,9 +21,103 @@ def text_(s, encoding='latin-1', errors='strict'):
     return s
 
 
+@contextmanager
+def atomic_open(path, mode='w'):
+    """ Open a temporary file, next to ``path``, which is renamed to
+    ``path`` once the ``with`` block completes (or removed, if it raises.)
+    """
+    dirpath, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % name, suffix='.tmp',
+                                    dir=dirpath or None)
+    try:
+        with os.fdopen(fd, mode) as fp:
+            yield fp
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
 def walk_items(item):
     items = deque([item])
     while items:
         item = items.popleft()
         items.extend(item.subitems)
         yield item
+
+
+def find_album(g2data, path=None, item_id=None):
+    """ Find an album in loaded metadata by ``path`` (relative to the
+    albums root) or by ``item_id``.
+
+    Returns ``None`` if there is no such album (or if it is not within
+    the loaded album, when the metadata is a dump of a subtree.)
+    """
+    if item_id is not None:
+        if hasattr(g2data, 'item'):
+            # normalized metadata can look items up by id
+            album = g2data.item(item_id)
+        else:
+            album = next((item for item in walk_items(g2data['album'])
+                          if item.id == item_id), None)
+    else:
+        album = g2data['album']
+        names = [name for name in (path or '').split('/')
+                 if name and name != '.']
+        # The loaded album may not be the albums root
+        prefix = [name for name in album.path.split('/') if name]
+        if names[:len(prefix)] != prefix:
+            return None
+        for name in names[len(prefix):]:
+            album = next((item for item in album.subitems
+                          if item.pathComponent == name), None)
+            if album is None:
+                break
+    return album if isinstance(album, meta.AlbumItem) else None
+
+
+def test_find_album():
+    def item(cls, item_id, path, *subitems):
+        obj = cls()
+        obj.__dict__.update(id=item_id, path=path,
+                            pathComponent=path.rsplit('/', 1)[-1],
+                            subitems=list(subitems))
+        return obj
+
+    tree = item(meta.AlbumItem, 1, '',
+                item(meta.AlbumItem, 2, 'a',
+                     item(meta.AlbumItem, 3, 'a/a',
+                          item(meta.PhotoItem, 4, 'a/a/p.jpg'))))
+    subtree, = tree.subitems
+
+    def find(g2data, path=None, item_id=None):
+        album = find_album({'album': g2data}, path, item_id)
+        return album.id if album is not None else None
+
+    assert find(tree) == 1
+    assert find(tree, './a/') == 2
+    assert find(tree, 'a/a') == 3
+    assert find(tree, 'a/a/p.jpg') is None
+    assert find(tree, item_id=3) == 3
+    assert find(subtree, 'a') == 2
+    assert find(subtree, 'a/a') == 3
+    assert find(subtree, '') is None
+    assert find(subtree, 'b') is None
+    assert find(subtree, item_id=1) is None
+
+
+def test_atomic_open(tmpdir):
+    path = str(tmpdir.join('out.yml'))
+    with atomic_open(path) as fp:
+        fp.write('one')
+    try:
+        with atomic_open(path) as fp:
+            fp.write('two')
+            raise ValueError
+    except ValueError:
+        pass
+    assert tmpdir.listdir() == [tmpdir.join('out.yml')]
+    assert tmpdir.join('out.yml').read() == 'one'
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+""" Keep sigal metadata in sync with a live gallery2 database.
+
+The database is polled (cheaply) for changes.  When something has
+changed, only the records of the changed items are fetched.  They are
+merged into an in-memory normalized record store, and only the affected
+``.md`` files (those of the changed items, and of their ancestors, whose
+hilights may depend on them) are rewritten.
+
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+import time
+
+import sqlalchemy as sa
+
+from . import dumper, models, sigal
+from .models.item import t_ItemHiddenMap
+from .normalized import NormalizedMetadata, RecordStore
+from .sigal.manifest import write_hidden_manifest
+
+log = logging.getLogger(__name__)
+
+MEDIA_CLASSES = ('AlbumItem', 'PhotoItem', 'MovieItem')
+
+
+def _md_path(record):
+    # The metadata file written by to-sigal for the item
+    if record['class'] == 'AlbumItem':
+        return os.path.join(record['path'], 'index.md')
+    return os.path.splitext(record['path'])[0] + '.md'
+
+
+class Watcher(object):
+    def __init__(self, session, albums_path, normalize=False):
+        self.session = session
+        self.albums_path = albums_path
+        self.normalize = normalize
+        self.records = None
+        self.store = None
+        self.state = None
+        self.hidden = None      # the ids of the hidden items
+        self.id_sum = None      # the sum of the ids of the stored items
+
+    def poll(self):
+        """ Check for changes, with a few aggregate queries.
+
+        Returns a tuple which changes whenever an entity is modified or
+        an item is added, deleted, hidden or unhidden.  (Its third and
+        fourth items are the number of items and the sum of their ids,
+        and its last a tuple of aggregates of the ids of the hidden
+        items.)
+        """
+        session = self.session
+        # Start a new transaction (to see recent changes.)  This also
+        # expires all instances.
+        session.rollback()
+        Entity = models.Entity
+        latest = session.query(
+            sa.func.max(Entity.modificationTimestamp)).scalar()
+        n_latest = session.query(sa.func.count(Entity.id))\
+                          .filter(Entity.modificationTimestamp == latest)\
+                          .scalar()
+        # (The sum catches an item deleted as another is added)
+        n_items, id_sum = session.query(sa.func.count(models.Item.id),
+                                        sa.func.sum(models.Item.id)).one()
+        # Hiding an item does not modify it.  (The sum of the squares
+        # catches most swaps of hidden items which keep the sum.)
+        hidden_id = t_ItemHiddenMap.c._ItemHiddenMap_itemId
+        hidden = session.query(sa.func.count(hidden_id),
+                               sa.func.sum(hidden_id),
+                               sa.func.sum(hidden_id * hidden_id)).one()
+        return latest, n_latest, n_items, id_sum, tuple(hidden)
+
+    def _hidden_ids(self):
+        return frozenset(item_id for item_id,
+                         in self.session.query(t_ItemHiddenMap))
+
+    def load(self):
+        """ Load the records for all items.
+        """
+        self.state = self.poll()
+        self.hidden = self._hidden_ids()
+        self.records = dumper.NormalizedRecords(self.session)
+        self.store = RecordStore(self.records.header())
+        for record in self.records.items():
+            self.store.add(record)
+        self.id_sum = sum(self.store.items)
+
+    def metadata(self):
+        return NormalizedMetadata(self.store)
+
+    def _changed_criterion(self, since, extra):
+        """ A criterion matching the items changed since ``since``, and
+        those with ids in ``extra``.
+        """
+        session = self.session
+        store = self.store
+        Item = models.Item
+        extra = set(extra)
+        # A new (or rebuilt) thumbnail may change an album's hilight
+        for parent_id, in session.query(models.Derivative.parentId)\
+                                 .filter(models.Derivative
+                                         .modificationTimestamp >= since):
+            record = store.get_item(parent_id)
+            if record is not None and record['class'] == 'AlbumItem':
+                extra.add(parent_id)
+
+        criterion = Item.modificationTimestamp >= since
+        if extra:
+            criterion = sa.or_(criterion, Item.id.in_(sorted(extra)))
+        return criterion
+
+    def _refresh(self, criterion):
+        # Bring the path and access list id maps used by
+        # ``NormalizedRecords`` up to date for the changed items.
+        session = self.session
+        records = self.records
+        Item = models.Item
+        subscriptions = models.AccessSubscriberMap
+        changed_ids = session.query(Item.id).filter(criterion)
+        records.access_list_ids.update(
+            session.query(subscriptions.itemId, subscriptions.accessListId)
+            .filter(subscriptions.itemId.in_(changed_ids)))
+
+        parents = dict(
+            (item_id, (parent_id, path_component))
+            for item_id, parent_id, path_component
+            in session.query(Item.id, Item.parentId, Item.pathComponent)
+            .filter(criterion))
+
+        def path(item_id):
+            if item_id not in parents:
+                record = self.store.get_item(item_id)
+                return record['path'] if record is not None else None
+            parent_id, path_component = parents[item_id]
+            parent_path = path(parent_id)
+            if parent_path is None:
+                return ''       # the root album
+            return os.path.join(parent_path, path_component)
+
+        for item_id in parents:
+            records.paths[item_id] = path(item_id)
+
+    def _deleted_ids(self):
+        """ Find the ids of the stored items which have been deleted.
+
+        Rather than fetching the ids of all items, the number and the sum
+        of the ids of the children of each album are compared, and only
+        the ids of the children of the albums which differ are fetched.
+        """
+        session = self.session
+        store = self.store
+        Item = models.Item
+        totals = dict(
+            (parent_id, (n_items, id_sum))
+            for parent_id, n_items, id_sum
+            in session.query(Item.parentId, sa.func.count(Item.id),
+                             sa.func.sum(Item.id))
+            .group_by(Item.parentId))
+        parent_ids = [parent_id
+                      for parent_id, item_ids in store.children.items()
+                      if item_ids and totals.get(parent_id)
+                      != (len(item_ids), sum(item_ids))]
+        if not parent_ids:
+            return set()
+        item_ids = set(item_id for item_id, in session.query(Item.id)
+                       .filter(Item.parentId.in_(parent_ids)))
+        return set(item_id for parent_id in parent_ids
+                   for item_id in store.get_children(parent_id)
+                   if item_id not in item_ids)
+
+    def _move_descendants(self, album_id, affected, moved):
+        # Update the paths of the descendants of a moved (or renamed)
+        # album.  Their old records are added to ``moved``.
+        store = self.store
+        parent_path = store.items[album_id]['path']
+        for item_id in list(store.get_children(album_id)):
+            record = store.items[item_id]
+            path = os.path.join(parent_path, record['pathComponent'])
+            if record['path'] != path:
+                moved.append(dict(record))
+                store.paths.pop(record['path'], None)
+                record['path'] = store.paths[path] = path
+                affected.add(item_id)
+                self._move_descendants(item_id, affected, moved)
+
+    def _remove_files(self, records):
+        # Remove the metadata files for (the old) ``records``
+        for record in records:
+            if record['class'] in MEDIA_CLASSES:
+                md_path = _md_path(record)
+                try:
+                    os.unlink(os.path.join(self.albums_path, md_path))
+                except OSError:
+                    pass
+                else:
+                    log.info("%s: removed", md_path)
+
+    def update(self):
+        """ Poll for changes, and rewrite the affected metadata files.
+
+        Returns the paths of the metadata files written.
+        """
+        state = self.poll()
+        if state == self.state:
+            return []
+        store = self.store
+        since = self.state[0]
+        hidden_ids = set()
+        if state[-1] != self.state[-1]:
+            # Some items have been hidden (or unhidden)
+            hidden = self._hidden_ids()
+            hidden_ids = hidden ^ self.hidden
+            self.hidden = hidden
+        criterion = self._changed_criterion(since, hidden_ids)
+        self._refresh(criterion)
+        store.header = self.records.header()
+
+        affected = set()
+        stale = []              # old records of moved and deleted items
+        hidden_changed = False
+        for record in self.records.items(criterion):
+            if record['class'] == 'Comment':
+                store.add(record)
+                continue
+            item_id = record['id']
+            old = store.get_item(item_id)
+            store.replace(record)
+            affected.add(item_id)
+            if old is None:
+                self.id_sum += item_id
+                hidden_changed |= record['is_hidden']
+                continue
+            hidden_changed |= old['is_hidden'] != record['is_hidden']
+            if old['parentId'] != record['parentId']:
+                affected.add(old['parentId'])
+            if old['path'] != record['path']:
+                stale.append(old)
+                self._move_descendants(item_id, affected, stale)
+
+        if (len(store.items), self.id_sum) != state[2:4]:
+            # Some items have been deleted
+            for item_id in self._deleted_ids():
+                record = store.remove(item_id)
+                self.id_sum -= item_id
+                stale.append(record)
+                affected.add(record['parentId'])
+                hidden_changed |= record['is_hidden']
+        self._remove_files(stale)
+
+        # The hilights of ancestors may depend on the changed items
+        for item_id in list(affected):
+            record = store.get_item(item_id)
+            while record is not None:
+                affected.add(record['id'])
+                record = store.get_item(record['parentId'])
+
+        g2data = self.metadata()
+        items = sorted((g2data.item(item_id) for item_id in affected
+                        if store.get_item(item_id) is not None),
+                       key=lambda item: item.path)
+        written = sigal.write_items(g2data, self.albums_path, items,
+                                    self.normalize)
+        if hidden_changed:
+            write_hidden_manifest(g2data['album'], self.albums_path)
+        self.state = state
+        return written
+
+    def run(self, interval, initial=True):
+        """ Watch for changes, every ``interval`` seconds, forever.
+
+        If ``initial`` is set, first write metadata for all items.
+        """
+        self.load()
+        log.info("Loaded %d items", len(self.store.items))
+        if initial:
+            sigal.write_metadata(self.metadata(), self.albums_path,
+                                 self.normalize)
+        while True:
+            time.sleep(interval)
+            for md_path in self.update():
+                log.info("%s: updated", md_path)
+
+
+def test_watcher(tmpdir):
+    from datetime import datetime
+    from sqlalchemy.orm import Session
+    from .models.entity import FileSystemEntity
+    from .models.item import t_Item, t_ItemAttributesMap
+    from .standin import create_engine, sample_gallery
+
+    engine = create_engine(str(tmpdir.join('gallery2.db')))
+    albums = tmpdir.join('albums')
+    for path in sample_gallery(engine):
+        if path.endswith('.jpg'):
+            albums.join(path).write('', ensure=True)
+        else:
+            albums.join(path).ensure(dir=True)
+
+    watcher = Watcher(Session(bind=engine), str(albums))
+    watcher.load()
+    sigal.write_metadata(watcher.metadata(), str(albums))
+    assert watcher.update() == []
+
+    def update():
+        # (Items modified as recently as the last change are rewritten
+        # again, so only check those expected are)
+        return set(watcher.update())
+
+    changes = [0]
+
+    def change(item_id, table=models.Entity.__table__, **values):
+        # Make a change, and mark the item as modified
+        changes[0] += 1
+        with engine.begin() as conn:
+            if values:
+                conn.execute(table.update()
+                             .where(list(table.primary_key)[0] == item_id)
+                             .values(**values))
+            conn.execute(models.Entity.__table__.update()
+                         .where(models.Entity.id == item_id)
+                         .values(modificationTimestamp=datetime(
+                             2002, 1, 1, 0, changes[0])))
+
+    def hide(item_id, hidden=True):
+        with engine.begin() as conn:
+            if hidden:
+                conn.execute(t_ItemHiddenMap.insert(),
+                             _ItemHiddenMap_itemId=item_id)
+            else:
+                conn.execute(t_ItemHiddenMap.delete().where(
+                    t_ItemHiddenMap.c._ItemHiddenMap_itemId == item_id))
+
+    def md(path):
+        md_path = albums.join(path)
+        return md_path.read() if md_path.check() else None
+
+    # edit
+    change(3, t_Item, title=u'New title')
+    assert update() >= set(['index.md', 'a/index.md', 'a/p.md'])
+    assert 'Title:           New title' in md('a/p.md')
+
+    # hide one item, and unhide another, without modifying either
+    hide(4)
+    assert update() >= set(['index.md', 'a/index.md', 'a/q.md'])
+    assert 'Hidden:          yes' in md('a/q.md')
+    hide(4, False)
+    hide(6)
+    assert update() >= set(['a/q.md', 'top.md'])
+    assert 'Hidden:          yes' not in md('a/q.md')
+    assert 'Hidden:          yes' in md('top.md')
+
+    # delete
+    with engine.begin() as conn:
+        for table in sa.inspect(models.PhotoItem).tables:
+            conn.execute(table.delete().where(
+                list(table.primary_key)[0] == 6))
+    assert 'index.md' in update()
+    assert md('top.md') is None
+
+    # move
+    albums.join('a', 'p.jpg').move(albums.join('b', 'p.jpg'))
+    change(3, models.ChildEntity.__table__, parentId=5)
+    change(3, t_ItemAttributesMap, parentSequence='1/5/')
+    assert update() >= set(['a/index.md', 'b/index.md', 'b/p.md'])
+    assert md('a/p.md') is None and md('b/p.md') is not None
+
+    # rename
+    albums.join('b').move(albums.join('c'))
+    change(5, FileSystemEntity.__table__, pathComponent='c')
+    assert update() >= set(['c/index.md', 'c/p.md'])
+    assert sorted(path.relto(albums) for path in albums.visit('*.md')) \
+        == ['a/index.md', 'a/q.md', 'c/index.md', 'c/p.md', 'index.md']
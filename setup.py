@@ -22,12 +22,17 @@ requires = [
     'piexif',
     'click',
     'six',
+    'scandir; python_version < "3.5"',
     ]
 
 testing_extras = [
     'pytest',
     ]
 
+columnar_extras = [
+    'pyarrow',
+    ]
+
 tests_require = testing_extras[:]
 
 
@@ -70,7 +75,7 @@ setup(
     url='',
     keywords='gallery2',
 
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
 
     install_requires=requires,
 
@@ -87,5 +92,6 @@ setup(
     cmdclass=cmdclass,
     extras_require={
         "testing": testing_extras,
+        "columnar": columnar_extras,
         },
     )